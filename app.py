@@ -1,13 +1,88 @@
+import tempfile
 import streamlit as st
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-from PIL import Image
-import requests
-from io import BytesIO
 from main import *
 
 openai.api_key = st.secrets["openai_api_key"]
 
 st.set_page_config(page_title="Product Explorer", layout="wide")
+
+# Shared across reruns and sessions so the model and index are loaded only once
+@st.cache_resource
+def load_retriever():
+    return get_retriever(st.secrets["openai_api_key"])
+
+@st.cache_resource
+def load_image_cache():
+    return get_image_cache() or ImageCache(tempfile.mkdtemp(), timeout=3)
+
+@st.cache_resource
+def load_thumbnail_pool():
+    # downloads the thumbnails of new results concurrently
+    return ThreadPoolExecutor(max_workers=image_download_workers)
+
+def fetch_thumbnails(urls):
+    # url -> future of the local thumbnail path, fetched in the background
+    image_cache = load_image_cache()
+    pool = load_thumbnail_pool()
+    return {url: pool.submit(image_cache.get_path, url, 'thumb')
+            for url in dict.fromkeys(urls) if isinstance(url, str)}
+
+def thumbnail_path(futures, url, wait=False):
+    # None while the thumbnail is still downloading (unless wait) or when it failed
+    future = futures.get(url)
+    if future is None or (not wait and not future.done()):
+        return None
+    try:
+        return future.result()
+    except Exception:
+        return None
+
+def render_product(row, thumbnail, pending=False):
+    with st.container():
+        cols = st.columns([1, 4])
+        # Image
+        with cols[0]:
+            if thumbnail:
+                # the cached file can be evicted between the fetch and a redraw
+                try:
+                    st.image(thumbnail, use_container_width=True)
+                except Exception:
+                    st.write("No Image")
+            else:
+                st.write("Loading image..." if pending else "No Image")
+
+        with cols[1]:
+            st.markdown(f"### {row['title']}")
+            if pending:
+                st.caption("⏳ Checking relevance...")
+            elif not row.get('verified', True):
+                st.caption("Not verified, the relevance check ran out of time")
+            st.markdown(f"**Price:** <span style='color:green; font-size:1.2em;'>${row['price']}</span>", unsafe_allow_html=True)
+            st.markdown(f"**Store:** {row['store']}  |  **Category:** {row['category']}  |  **Subcategory:** {row['subcategory']}")
+            variants = row.get('variants')
+            if isinstance(variants, list) and variants:
+                st.caption(f"{len(variants)} near-identical listing(s) from other sellers or colours: {', '.join(v['parent_asin'] for v in variants[:5])}")
+            st.markdown(
+                f"**Rating:** ⭐ {row['average_rating']} &nbsp;&nbsp;|&nbsp;&nbsp; **Reviews:** {row['rating_number']}",
+                unsafe_allow_html=True
+            )
+            if row['description']:
+                st.markdown("**Description:**")
+                st.markdown("\n".join([f"- {item}" for item in row['description']]))
+            if row['features']:
+                st.markdown("**Features:**")
+                st.markdown("\n".join([f"- {item}" for item in row['features']]))
+            if row['details'] and isinstance(row['details'], dict):
+                st.markdown("**More Details:**")
+                details_html = "<ul>"
+                for k, v in row['details'].items():
+                    details_html += f"<li>{k}: {v}</li>"
+                details_html += "</ul>"
+                st.markdown(details_html, unsafe_allow_html=True)
+        st.markdown("---")
+
 st.title("🛍️ Product Explorer")
 
 # Text input for the search query
@@ -18,14 +93,73 @@ if "last_query" not in st.session_state:
     st.session_state.last_query = ""
 if "df" not in st.session_state:
     st.session_state.df = pd.DataFrame()
+if "thumbnails" not in st.session_state:
+    # main_image url -> local thumbnail path of the current results, redraws do no network I/O
+    st.session_state.thumbnails = {}
+
+# Search filters are applied inside the vector search, so narrow filters still return a full top-k
+metadata_filter = load_retriever().metadata_filter
+search_filters = {}
+with st.sidebar.expander("🎯 Search filters", expanded=False):
+    search_filters['category'] = st.multiselect("Category", list(fashion_categories.keys())) or None
+    search_filters['subcategory'] = st.multiselect(
+        "Subcategory", [sub for subs in fashion_categories.values() for sub in subs]
+    ) or None
+    search_filters['store'] = st.multiselect("Store", metadata_filter.options('store')) or None
+    for col, label in [('price', "Price Range"), ('rating_number', "Review Count"), ('average_rating', "Review Rating")]:
+        if col in metadata_filter.values:
+            low, high = metadata_filter.bounds(col)
+            if low < high:
+                selected = st.slider(label, min_value=low, max_value=high, value=(low, high), key=f"search_{col}")
+                search_filters[col] = selected if selected != (low, high) else None
+search_filters = {k: v for k, v in search_filters.items() if v is not None}
 
 # Add a search button
 search_clicked = st.button("Search")
 
 # Only retrieve data when the button is clicked
-if search_clicked and query and query != st.session_state.last_query:
-    st.session_state.df = retrieve(query, st.secrets["openai_api_key"])
-    st.session_state.last_query = query
+search_key = (query, repr(sorted(search_filters.items())))
+if search_clicked and query and search_key != st.session_state.last_query:
+    # progressive results: the FAISS hits are shown at once and refined in place
+    # as the relevance verdicts come back
+    live = st.empty()
+    progress = {'candidates': pd.DataFrame(), 'verdicts': {}, 'thumbnails': {}}
+
+    def show_progress():
+        candidates = progress['candidates']
+        if candidates.empty:
+            return
+        verdicts = progress['verdicts']
+        shown = candidates[[verdicts.get(asin, True) for asin in candidates['parent_asin']]]
+        shown = shown.drop_duplicates(subset=['title'])
+        with live.container():
+            st.info(f"Checking relevance: {len(verdicts)} / {len(candidates)} products checked")
+            for _, row in shown.iterrows():
+                render_product(row, thumbnail_path(progress['thumbnails'], row['main_image']),
+                               pending=row['parent_asin'] not in verdicts)
+
+    def on_candidates(candidates):
+        progress['candidates'] = candidates
+        if not candidates.empty:
+            progress['thumbnails'] = fetch_thumbnails(candidates['main_image'])
+        show_progress()
+
+    def on_verdicts(verdicts):
+        progress['verdicts'].update(verdicts)
+        show_progress()
+
+    df = load_retriever().search(query,
+                                 openai_api_key=st.secrets["openai_api_key"],
+                                 filters=search_filters,
+                                 on_candidates=on_candidates,
+                                 on_verdicts=on_verdicts)
+    live.empty()
+    st.session_state.df = df
+    st.session_state.thumbnails = {
+        url: thumbnail_path(progress['thumbnails'], url, wait=True)
+        for url in (df['main_image'] if not df.empty else [])
+    }
+    st.session_state.last_query = search_key
     
 df = st.session_state.df
         
@@ -80,39 +214,7 @@ if not df.empty:
     st.write(f"Showing {len(filtered_df)} results")
 
     for idx, row in filtered_df.iterrows():
-        with st.container():
-            cols = st.columns([1, 4])
-            # Image
-            with cols[0]:
-                try:
-                    response = requests.get(row["main_image"], stream=True, timeout=3)
-                    image = Image.open(BytesIO(response.content)).convert("RGB")
-                    st.image(image, use_container_width=True)
-                except Exception:
-                    st.write("No Image")
-
-            with cols[1]:
-                st.markdown(f"### {row['title']}")
-                st.markdown(f"**Price:** <span style='color:green; font-size:1.2em;'>${row['price']}</span>", unsafe_allow_html=True)
-                st.markdown(f"**Store:** {row['store']}  |  **Category:** {row['category']}  |  **Subcategory:** {row['subcategory']}")
-                st.markdown(
-                    f"**Rating:** ⭐ {row['average_rating']} &nbsp;&nbsp;|&nbsp;&nbsp; **Reviews:** {row['rating_number']}",
-                    unsafe_allow_html=True
-                )
-                if row['description']:
-                    st.markdown("**Description:**")
-                    st.markdown("\n".join([f"- {item}" for item in row['description']]))
-                if row['features']:
-                    st.markdown("**Features:**")
-                    st.markdown("\n".join([f"- {item}" for item in row['features']]))
-                if row['details'] and isinstance(row['details'], dict):
-                    st.markdown("**More Details:**")
-                    details_html = "<ul>"
-                    for k, v in row['details'].items():
-                        details_html += f"<li>{k}: {v}</li>"
-                    details_html += "</ul>"
-                    st.markdown(details_html, unsafe_allow_html=True)
-            st.markdown("---")
+        render_product(row, st.session_state.thumbnails.get(row['main_image']))
             
 else:
     if search_clicked:
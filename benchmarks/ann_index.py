@@ -0,0 +1,118 @@
+# Recall@k against the exact flat index, QPS, build time and memory of each FAISS index type.
+# Lossy types (sq_fp16, sq_int8, ivf_pq) are also measured with re-ranking against memory-mapped
+# full-precision vectors, as the Retriever does.
+# usage: python -m benchmarks.ann_index --embeddings ./index/tmp/embeddings.npy --k 10
+#        python -m benchmarks.ann_index --n 200000   (synthetic clustered vectors)
+import os
+import time
+import json
+import argparse
+import tempfile
+
+import faiss
+import numpy as np
+
+from config import index_params, rerank_factor
+from index import (build_faiss_index, set_search_params, rerank, write_full_vectors,
+                   load_full_vectors, LOSSY_INDEX_TYPES)
+
+
+def synthetic_embeddings(n, dim, n_clusters=1000, seed=0):
+    # clustered vectors, closer to real CLIP embeddings than uniform noise
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim)).astype(np.float32)
+    x = centers[rng.integers(0, n_clusters, n)] + 0.5 * rng.normal(size=(n, dim)).astype(np.float32)
+    faiss.normalize_L2(x)
+    return x
+
+
+def recall_at_k(I, I_true):
+    k = I_true.shape[1]
+    hits = sum(len(np.intersect1d(a[a >= 0], b)) for a, b in zip(I, I_true))
+    return hits / (len(I_true) * k)
+
+
+def measure(index, queries, k, I_true, full_vectors=None, factor=1):
+    start = time.perf_counter()
+    if full_vectors is None:
+        _, I = index.search(queries, k)
+    else:
+        _, I = index.search(queries, k * factor)
+        _, I = rerank(queries, I, full_vectors, k)
+    elapsed = time.perf_counter() - start
+    return {'recall': recall_at_k(I, I_true), 'qps': len(queries) / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--embeddings', help='.npy matrix of product embeddings')
+    parser.add_argument('--n', type=int, default=100000, help='synthetic catalog size')
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--types', default='flat,sq_fp16,sq_int8,ivf_flat,ivf_pq,hnsw')
+    parser.add_argument('--rerank-factor', type=int, default=rerank_factor)
+    parser.add_argument('--output', help='write the results as json')
+    args = parser.parse_args()
+
+    if args.embeddings:
+        x = np.ascontiguousarray(np.load(args.embeddings, mmap_mode='r'), dtype=np.float32)
+        faiss.normalize_L2(x)
+    else:
+        x = synthetic_embeddings(args.n, args.dim)
+    # queries: perturbed catalog vectors
+    rng = np.random.default_rng(1)
+    queries = x[rng.choice(len(x), args.queries, replace=False)] + 0.1 * rng.normal(size=(args.queries, x.shape[1])).astype(np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    faiss.normalize_L2(queries)
+    print(f"{len(x)} vectors of dim {x.shape[1]}, {len(queries)} queries, k={args.k}")
+
+    exact = faiss.IndexFlatIP(x.shape[1])
+    exact.add(x)
+    _, I_true = exact.search(queries, args.k)
+
+    # full-precision copy on disk, read through a memory map when re-ranking
+    tmp_dir = tempfile.TemporaryDirectory()
+    vectors_file = os.path.join(tmp_dir.name, 'vectors.f32')
+    write_full_vectors(vectors_file, x)
+    full_vectors = load_full_vectors(vectors_file, x.shape[1])
+    flat_mb = x.nbytes / 1024 ** 2
+
+    results = []
+    for index_type in args.types.split(','):
+        start = time.perf_counter()
+        index = build_faiss_index(x, index_type=index_type, **index_params)
+        build_time = time.perf_counter() - start
+        memory_mb = faiss.serialize_index(index).nbytes / 1024 ** 2
+        reranks = [None, full_vectors] if index_type in LOSSY_INDEX_TYPES and args.rerank_factor > 1 else [None]
+
+        # sweep the query-time knob of the approximate indexes
+        if index_type.startswith('ivf'):
+            settings = [{'nprobe': p} for p in (1, 4, 16, 64, 256)]
+        elif index_type == 'hnsw':
+            settings = [{'ef_search': e} for e in (16, 32, 64, 128, 256)]
+        else:
+            settings = [{}]
+
+        for setting in settings:
+            set_search_params(index, **setting)
+            for vectors in reranks:
+                factor = args.rerank_factor if vectors is not None else 1
+                row = {'index_type': index_type, **setting, 'rerank_factor': factor, 'build_s': build_time,
+                       'memory_mb': memory_mb, 'memory_saved_vs_flat': 1 - memory_mb / flat_mb,
+                       **measure(index, queries, args.k, I_true, vectors, factor)}
+                results.append(row)
+                knob = ', '.join(f"{k}={v}" for k, v in setting.items()) or '-'
+                if vectors is not None:
+                    knob += f" rerank x{factor}"
+                print(f"{index_type:<9} {knob:<24} recall@{args.k}={row['recall']:.3f}  "
+                      f"qps={row['qps']:>10,.0f}  build={build_time:.1f}s  memory={memory_mb:,.0f}MB "
+                      f"({row['memory_saved_vs_flat']:.0%} saved)")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+# Offline end-to-end benchmark: synthetic catalog -> prepare_data -> embeddings -> FAISS index -> retrieval,
+# with deterministic fakes for the OpenAI calls (and optionally the CLIP model), results written as json.
+# usage: python -m benchmarks.end_to_end --n 5000 --llm-latency 0.8 --vision-latency 2.0 --output e2e.json
+#        python -m benchmarks.end_to_end --model clip   (real CLIP models from config.py)
+import io
+import os
+import time
+import json
+import argparse
+import tempfile
+import contextlib
+
+import numpy as np
+
+import index as index_module
+from config import *
+from metrics import metrics
+from data_process import prepare_data, CategoryTagger
+from index import save_faiss_index_and_metadata
+from dedup import collapse_near_duplicates, format_report
+from benchmarks.synthetic import (generate_catalog, FakeEncoder, fake_rephrase,
+                                  fake_post_extraction_check, SAMPLE_QUERIES)
+
+
+def percentiles(values):
+    values = np.asarray(values, dtype=np.float64) * 1000
+    return {'mean_ms': float(values.mean()), 'p50_ms': float(np.percentile(values, 50)),
+            'p90_ms': float(np.percentile(values, 90)), 'p99_ms': float(np.percentile(values, 99)),
+            'n': int(len(values))}
+
+
+class StageTimer:
+    """Accumulates the time spent in wrapped functions during one query."""
+
+    def __init__(self):
+        self.current = {}
+
+    def wrap(self, stage, fn):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.current[stage] = self.current.get(stage, 0.0) + time.perf_counter() - start
+        return timed
+
+    def reset(self):
+        stages, self.current = self.current, {}
+        return stages
+
+
+class TimedEncoder:
+    # forwards encode to the wrapped model, timed as the "encode" stage
+    def __init__(self, model, timer):
+        self.model = model
+        self.encode = timer.wrap('encode', model.encode)
+
+
+@contextlib.contextmanager
+def quiet(verbose):
+    if verbose:
+        yield
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+
+
+def load_models(model):
+    if model == 'fake':
+        encoder = FakeEncoder()
+        return encoder, encoder
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(img_model_path), SentenceTransformer(text_model_path)
+
+
+def run_retrieval(retriever, timer, queries, repeats, base_k, verbose):
+    # one pass over the queries, per-query total and per-stage latencies
+    totals, stages = [], {}
+    for _ in range(repeats):
+        for query in queries:
+            timer.reset()
+            start = time.perf_counter()
+            with quiet(verbose):
+                retriever.search(query, base_k=base_k)
+            total = time.perf_counter() - start
+            per_stage = timer.reset()
+            # everything outside the wrapped calls: faiss search, fusion, metadata lookups, dedup
+            per_stage['search'] = total - sum(per_stage.values())
+            totals.append(total)
+            for stage, seconds in per_stage.items():
+                stages.setdefault(stage, []).append(seconds)
+    return {'total': percentiles(totals), **{s: percentiles(v) for s, v in stages.items()}}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n', type=int, default=5000, help='synthetic catalog size')
+    parser.add_argument('--workdir', help='catalog, images and index go here (default: a temporary folder)')
+    parser.add_argument('--model', choices=['fake', 'clip'], default='fake')
+    parser.add_argument('--index-type', default=index_type)
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='seconds per fake rephrase call')
+    parser.add_argument('--vision-latency', type=float, default=1.0, help='seconds per fake vision batch')
+    parser.add_argument('--relevant-rate', type=float, default=0.5)
+    parser.add_argument('--base-k', type=int, default=base_k)
+    parser.add_argument('--verify-target', type=int, default=verification_target)
+    parser.add_argument('--verify-budget-s', type=float, default=verification_budget_s)
+    parser.add_argument('--verify-all', action='store_true',
+                        help='check every candidate without target or budget, the baseline for the vision call count')
+    parser.add_argument('--repeats', type=int, default=3, help='passes over the queries, the first one is cold')
+    parser.add_argument('--reupload-rate', type=float, default=0.1, help='share of near-duplicate listings in the catalog')
+    parser.add_argument('--dedup-threshold', type=float, default=dedup_threshold)
+    parser.add_argument('--no-dedup', action='store_true', help='index every listing, the baseline for the dedup report')
+    parser.add_argument('--n-jobs', type=int, default=1, help='prepare_data n_jobs')
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--output', help='write the results as json')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.workdir or tmp
+        catalog_path = os.path.join(workdir, 'catalog.jsonl')
+        bench_index_path = os.path.join(workdir, 'faiss_index.index')
+        bench_metadata_path = os.path.join(workdir, 'faiss_metadata')
+        results = {'config': vars(args)}
+
+        print(f"Generating a synthetic catalog of {args.n} products...")
+        start = time.perf_counter()
+        generate_catalog(catalog_path, os.path.join(workdir, 'images'), n_products=args.n,
+                         reupload_rate=args.reupload_rate)
+        results['generate'] = {'products': args.n, 'seconds': time.perf_counter() - start}
+
+        start = time.perf_counter()
+        with quiet(args.verbose):
+            data = prepare_data(catalog_path, cols_to_drop=cols_to_drop, n_jobs=args.n_jobs)
+        elapsed = time.perf_counter() - start
+        results['prepare_data'] = {'rows': len(data), 'seconds': elapsed, 'rows_per_s': args.n / elapsed}
+        print(f"prepare_data: {args.n / elapsed:,.0f} rows/s ({len(data)} products kept)")
+
+        # embed_and_tag lives in main.py next to index_creation
+        from main import embed_and_tag
+        img_model, text_model = load_models(args.model)
+        tagger = CategoryTagger.from_model(fashion_categories, text_model)
+        start = time.perf_counter()
+        with quiet(args.verbose):
+            metadata, embeddings = embed_and_tag(data, img_model, text_model, tagger)
+        elapsed = time.perf_counter() - start
+        results['embedding'] = {'rows': len(data), 'seconds': elapsed, 'rows_per_s': len(data) / elapsed}
+        print(f"embedding: {len(data) / elapsed:,.0f} products/s")
+
+        if not args.no_dedup:
+            start = time.perf_counter()
+            with quiet(args.verbose):
+                metadata, embeddings, report = collapse_near_duplicates(metadata, embeddings,
+                                                                        threshold=args.dedup_threshold,
+                                                                        n_neighbors=dedup_neighbors,
+                                                                        index_type=args.index_type,
+                                                                        nprobe=nprobe, ef_search=ef_search,
+                                                                        base_k=args.base_k, **index_params)
+            results['dedup'] = {**report, 'seconds': time.perf_counter() - start}
+            print(format_report(report))
+
+        start = time.perf_counter()
+        with quiet(args.verbose):
+            save_faiss_index_and_metadata(bench_index_path, bench_metadata_path, embeddings=embeddings,
+                                          metadata=metadata, index_type=args.index_type, **index_params)
+        elapsed = time.perf_counter() - start
+        results['index_build'] = {'vectors': len(metadata), 'seconds': elapsed,
+                                  'vectors_per_s': len(metadata) / elapsed, 'index_type': args.index_type}
+        print(f"index build ({args.index_type}): {len(metadata) / elapsed:,.0f} vectors/s")
+
+        # fake LLM calls, timed per stage together with the text encoder
+        timer = StageTimer()
+        index_module._rephrase_with_llm = fake_rephrase(args.llm_latency)
+        index_module.post_extraction_check = fake_post_extraction_check(args.vision_latency, args.relevant_rate)
+        index_module.rephrase_query_for_embedding = timer.wrap('rephrase', index_module.rephrase_query_for_embedding)
+        index_module.verify_candidates = timer.wrap('verify', index_module.verify_candidates)
+
+        import retriever as retriever_module
+        from retriever import Retriever
+        retriever_module.verification_target = None if args.verify_all else args.verify_target
+        retriever_module.verification_budget_s = None if args.verify_all else args.verify_budget_s
+        with quiet(args.verbose):
+            # in-memory caches only, the benchmark never touches cache_db_path
+            retriever = Retriever(bench_index_path, bench_metadata_path, openai_api_key='offline',
+                                  text_model=TimedEncoder(text_model, timer), cache_db_path=None,
+                                  text_model_name='fake' if args.model == 'fake' else text_model_path)
+
+        metrics.reset()
+        results['retrieve_cold'] = run_retrieval(retriever, timer, SAMPLE_QUERIES, 1, args.base_k, args.verbose)
+        counters = metrics.snapshot()['counters']
+        results['vision_calls_per_query'] = counters.get('llm_calls_total{kind=verification}', 0) / len(SAMPLE_QUERIES)
+        results['unverified_stops'] = counters.get('verification_early_stops_total{reason=budget}', 0)
+        results['retrieve_warm'] = run_retrieval(retriever, timer, SAMPLE_QUERIES, max(args.repeats - 1, 1),
+                                                 args.base_k, args.verbose)
+        results['cache_stats'] = retriever.cache_stats()
+
+        print(f"vision calls per cold query: {results['vision_calls_per_query']:.1f} "
+              f"({results['unverified_stops']} queries ran out of verification budget)")
+        for name in ('retrieve_cold', 'retrieve_warm'):
+            print(name)
+            for stage, p in results[name].items():
+                print(f"  {stage:<10} p50={p['p50_ms']:>9.1f}ms  p90={p['p90_ms']:>9.1f}ms  p99={p['p99_ms']:>9.1f}ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+# Load generator for the retrieval server: concurrent keep-alive clients posting /search.
+# usage: python -m benchmarks.load_test --url http://127.0.0.1:8000 --concurrency 32 --requests 1000
+#        python -m benchmarks.load_test --index-path ./index/faiss_index.index --metadata-path ./index/faiss_metadata \
+#               --max-wait-ms 5     (starts an in-process server with fake LLM calls, see benchmarks/synthetic.py)
+# --max-wait-ms 0 --max-batch-keywords 1 turns micro-batching off for comparison.
+import json
+import time
+import asyncio
+import argparse
+import threading
+from urllib.parse import urlparse
+
+import numpy as np
+
+from config import *
+from metrics import metrics
+from benchmarks.synthetic import SAMPLE_QUERIES
+
+
+async def post(reader, writer, host, path, payload):
+    body = json.dumps(payload).encode('utf-8')
+    writer.write(f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode('latin-1') + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+async def client(host, port, queries, counter, n_requests, latencies, errors, base_k, unique):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while True:
+            i = counter[0]
+            if i >= n_requests:
+                break
+            counter[0] += 1
+            query = queries[i % len(queries)]
+            if unique:
+                # a different text per request, the rephrase / verdict caches do not help
+                query = f"{query} {i}"
+            start = time.perf_counter()
+            try:
+                status = await post(reader, writer, host, '/search', {'query': query, 'base_k': base_k})
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                errors.append(type(e).__name__)
+                break
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def run_load(host, port, concurrency, n_requests, base_k, unique):
+    latencies, errors, counter = [], [], [0]
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        client(host, port, SAMPLE_QUERIES, counter, n_requests, latencies, errors, base_k, unique)
+        for _ in range(concurrency)
+    ])
+    elapsed = time.perf_counter() - start
+    ms = np.asarray(latencies) * 1000
+    return {'requests': len(latencies), 'errors': len(errors), 'seconds': elapsed,
+            'qps': len(latencies) / elapsed,
+            'p50_ms': float(np.percentile(ms, 50)), 'p90_ms': float(np.percentile(ms, 90)),
+            'p99_ms': float(np.percentile(ms, 99)), 'max_ms': float(ms.max())}
+
+
+def start_inprocess_server(args):
+    # the server runs in a background thread with fake OpenAI calls
+    import index as index_module
+    from retriever import Retriever
+    from server import RetrievalServer
+    from benchmarks.synthetic import FakeEncoder, fake_rephrase, fake_post_extraction_check
+
+    index_module._rephrase_with_llm = fake_rephrase(args.llm_latency)
+    index_module.post_extraction_check = fake_post_extraction_check(args.vision_latency)
+    if args.model == 'fake':
+        text_model = FakeEncoder(dim=args.dim, latency_per_call=args.encode_latency)
+    else:
+        from sentence_transformers import SentenceTransformer
+        text_model = SentenceTransformer(text_model_path)
+    retriever = Retriever(args.index_path, args.metadata_path, openai_api_key='offline',
+                          text_model=text_model, cache_db_path=None,
+                          text_model_name=f'fake-{args.dim}' if args.model == 'fake' else text_model_path)
+    server = RetrievalServer(retriever,
+                             request_workers=args.request_workers,
+                             max_batch_keywords=args.max_batch_keywords,
+                             max_wait_ms=args.max_wait_ms)
+    ready = threading.Event()
+    thread = threading.Thread(target=lambda: asyncio.run(server.serve('127.0.0.1', args.port, ready)), daemon=True)
+    thread.start()
+    ready.wait()
+    return f"http://127.0.0.1:{args.port}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', help='running server, otherwise an in-process server is started')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--base-k', type=int, default=base_k)
+    parser.add_argument('--unique', action='store_true', help='make every query text unique')
+    # in-process server
+    parser.add_argument('--index-path', default=index_path)
+    parser.add_argument('--metadata-path', default=metadata_path)
+    parser.add_argument('--port', type=int, default=server_port)
+    parser.add_argument('--model', choices=['fake', 'clip'], default='fake')
+    parser.add_argument('--dim', type=int, default=512, help='fake encoder dimension, must match the index')
+    parser.add_argument('--encode-latency', type=float, default=0.02, help='seconds per fake encode call')
+    parser.add_argument('--llm-latency', type=float, default=0.5)
+    parser.add_argument('--vision-latency', type=float, default=1.0)
+    parser.add_argument('--max-wait-ms', type=float, default=server_batch_wait_ms)
+    parser.add_argument('--max-batch-keywords', type=int, default=server_max_batch_keywords)
+    parser.add_argument('--request-workers', type=int, default=server_request_workers)
+    parser.add_argument('--output', help='write the results as json')
+    args = parser.parse_args()
+
+    url = urlparse(args.url or start_inprocess_server(args))
+    print(f"{args.requests} requests, {args.concurrency} concurrent clients against {url.geturl()}")
+    result = asyncio.run(run_load(url.hostname, url.port, args.concurrency, args.requests, args.base_k, args.unique))
+    result['config'] = vars(args)
+    if not args.url:
+        counters = metrics.snapshot()['counters']
+        batches = counters.get('server_batches_total', 0)
+        result['mean_batch_requests'] = counters.get('server_batched_requests_total', 0) / batches if batches else 0
+    print(f"qps={result['qps']:.1f}  p50={result['p50_ms']:.0f}ms  p90={result['p90_ms']:.0f}ms  "
+          f"p99={result['p99_ms']:.0f}ms  errors={result['errors']}"
+          + (f"  requests/batch={result['mean_batch_requests']:.1f}" if 'mean_batch_requests' in result else ''))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+# Synthetic catalog in the meta_Amazon_Fashion.jsonl schema with locally generated images,
+# plus deterministic stand-ins for the OpenAI calls and the CLIP model, for offline benchmarks.
+import os
+import json
+import time
+import hashlib
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from config import fashion_categories
+
+COLORS = {
+    'red': (200, 30, 40), 'blue': (30, 60, 200), 'green': (40, 160, 60), 'black': (20, 20, 20),
+    'white': (240, 240, 240), 'yellow': (230, 210, 40), 'pink': (240, 140, 180), 'brown': (120, 80, 40),
+}
+MATERIALS = ['cotton', 'leather', 'denim', 'silk', 'wool', 'polyester', 'linen', 'suede']
+STYLES = ['classic', 'vintage', 'slim fit', 'oversized', 'floral', 'striped', 'casual', 'formal']
+STORES = [f'Store {i}' for i in range(50)]
+SUBCATEGORIES = [sub for subs in fashion_categories.values() for sub in subs]
+
+
+def _seed(*parts):
+    return int(hashlib.md5('|'.join(map(str, parts)).encode('utf-8')).hexdigest()[:8], 16)
+
+
+def make_image(path, color, shape_id, size=256):
+    image = Image.new('RGB', (size, size), (250, 250, 250))
+    draw = ImageDraw.Draw(image)
+    margin = size // 6
+    box = [margin, margin, size - margin, size - margin]
+    [draw.rectangle, draw.ellipse, draw.polygon][shape_id % 3](
+        box if shape_id % 3 < 2 else [(size // 2, margin), (margin, size - margin), (size - margin, size - margin)],
+        fill=color)
+    image.save(path, format='JPEG', quality=85)
+
+
+def generate_catalog(output_path, image_dir, n_products=10000, duplicate_rate=0.05,
+                     missing_price_rate=0.05, missing_image_rate=0.02, n_images=500, seed=0,
+                     reupload_rate=0.0):
+    # images are shared between products (n_images distinct files) to keep generation fast.
+    # reupload_rate: share of listings that copy an earlier one (same image, description and
+    # details) under another store with a slightly different title, the near duplicates
+    # dedup.py collapses
+    rng = np.random.default_rng(seed)
+    os.makedirs(image_dir, exist_ok=True)
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+
+    color_names = list(COLORS)
+    image_paths = []
+    for i in range(n_images):
+        path = os.path.join(image_dir, f'img_{i:05d}.jpg')
+        if not os.path.exists(path):
+            make_image(path, COLORS[color_names[i % len(color_names)]], i)
+        image_paths.append(os.path.abspath(path))
+
+    titles = []
+    records = []
+    with open(output_path, 'w') as f:
+        for i in range(n_products):
+            if reupload_rate and records and rng.random() < reupload_rate:
+                record = dict(records[rng.integers(len(records))])
+                record.update({'title': f"{record['title']} {['new', '2024', 'gift'][rng.integers(3)]}",
+                               'store': STORES[rng.integers(len(STORES))],
+                               'rating_number': int(rng.integers(0, 50)),
+                               'parent_asin': f"B{i:09d}"})
+                titles.append(record['title'])
+                f.write(json.dumps(record) + '\n')
+                continue
+            color = color_names[rng.integers(len(color_names))]
+            material = MATERIALS[rng.integers(len(MATERIALS))]
+            style = STYLES[rng.integers(len(STYLES))]
+            subcategory = SUBCATEGORIES[rng.integers(len(SUBCATEGORIES))]
+            if titles and rng.random() < duplicate_rate:
+                title = titles[rng.integers(len(titles))]
+            else:
+                title = f"{style} {color} {material} {subcategory.lower()} #{i}"
+            titles.append(title)
+
+            image = image_paths[(color_names.index(color) + len(color_names) * rng.integers(n_images // len(color_names))) % n_images]
+            record = {
+                'main_category': 'AMAZON FASHION',
+                'title': title,
+                'average_rating': round(float(rng.uniform(1, 5)), 1),
+                'rating_number': int(rng.integers(0, 5000)),
+                'features': [f"{material} fabric", f"{style} look", "machine washable"][:int(rng.integers(0, 4))],
+                'description': [f"A {color} {subcategory.lower()} made of {material}."] if rng.random() < 0.7 else [],
+                'price': None if rng.random() < missing_price_rate else round(float(rng.uniform(5, 300)), 2),
+                'images': [] if rng.random() < missing_image_rate else [
+                    {'thumb': image, 'large': image, 'variant': 'MAIN', 'hi_res': None}
+                ],
+                'videos': [],
+                'store': STORES[rng.integers(len(STORES))],
+                'categories': [],
+                'details': {'Brand': f"Brand {rng.integers(200)}", 'Color': color, 'Material': material,
+                            'Date First Available': 'January 1, 2020'},
+                'parent_asin': f"B{i:09d}",
+                'bought_together': None,
+            }
+            if reupload_rate:
+                records.append(record)
+            f.write(json.dumps(record) + '\n')
+    return output_path
+
+
+class FakeEncoder:
+    """Deterministic stand-in for the CLIP SentenceTransformer: texts hash to fixed vectors,
+    images map to a vector of their mean colour, so similar inputs land close together."""
+
+    def __init__(self, dim=512, latency_per_item=0.0, latency_per_call=0.0):
+        # latency_per_call: fixed cost of a forward pass, what batching saves
+        self.dim = dim
+        self.latency_per_item = latency_per_item
+        self.latency_per_call = latency_per_call
+        self._color_basis = np.random.default_rng(0).normal(size=(3, dim)).astype(np.float32)
+
+    def _text_vector(self, text):
+        # sum of per-word vectors, texts sharing words get similar embeddings
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for word in str(text).lower().split():
+            vec += np.random.default_rng(_seed(word)).normal(size=self.dim).astype(np.float32)
+        return vec
+
+    def _image_vector(self, image):
+        rgb = np.asarray(image.convert('RGB'), dtype=np.float32).reshape(-1, 3).mean(axis=0) / 255.0
+        return rgb @ self._color_basis
+
+    def encode(self, items, batch_size=32, **kwargs):
+        single = isinstance(items, str) or isinstance(items, Image.Image)
+        items = [items] if single else list(items)
+        if self.latency_per_item or self.latency_per_call:
+            time.sleep(self.latency_per_call + self.latency_per_item * len(items))
+        out = np.vstack([
+            self._text_vector(x) if isinstance(x, str) else self._image_vector(x) for x in items
+        ]) if items else np.empty((0, self.dim), dtype=np.float32)
+        return out[0] if single else out
+
+
+def fake_rephrase(latency=0.0):
+    # deterministic replacement for the GPT-4.1 call in rephrase_query_for_embedding
+    def rephrase(user_query, system_prompt, client=None):
+        time.sleep(latency)
+        query = user_query.lower()
+        if 'pizza' in query or 'weather' in query:
+            return "not relevant to fashion products"
+        words = set(query.split())
+        matches = [sub.lower() for sub in SUBCATEGORIES if words & set(sub.lower().replace('&', ' ').split())]
+        return (matches or [query])[:5]
+    return rephrase
+
+
+def fake_post_extraction_check(latency=0.0, relevant_rate=0.5):
+    # deterministic replacement for the GPT-4.1 vision relevance check
+    def check(image_dict, query, openai_api_key, client=None):
+        time.sleep(latency)
+        return [k for k in image_dict if _seed(query, k) % 1000 < relevant_rate * 1000]
+    return check
+
+
+SAMPLE_QUERIES = [
+    "I need a gym outfit",
+    "a red dress with floral pattern",
+    "leather boots for winter",
+    "summer beach outfit with sandals",
+    "black crossbody bag",
+    "wool sweaters",
+    "sunglasses and hats",
+    "formal heels for a wedding",
+    "denim jeans",
+    "what is the weather tomorrow",
+]
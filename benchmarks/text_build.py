@@ -0,0 +1,62 @@
+# Rows / second of the text construction in data_process, before and after vectorization.
+# usage: python -m benchmarks.text_build --input ./data/meta_Amazon_Fashion.jsonl --rows 100000 --n_jobs 4
+import re
+import time
+import argparse
+
+import pandas as pd
+
+from data_process import *
+
+
+def remove_emojis_rowwise(text):
+    # original implementation, recompiles the pattern on every row
+    emoji_pattern = re.compile(EMOJI_PATTERN.pattern, flags=re.UNICODE)
+    text = emoji_pattern.sub(' ', text)
+    text = re.sub(r'\s+', ' ', text)
+    return text.strip()
+
+
+def build_text_columns_rowwise(data):
+    # original row-wise .apply implementation, used as the baseline
+    data = data.copy()
+    data['features_t'] = data['features'].apply(process_list)
+    data['description_t'] = data['description'].apply(process_list)
+    data['details'] = data['details'].apply(lambda x: process_details(x, details_map=details_map))
+    data['details_t'] = data['details'].apply(lambda x: proecss_dict(x, delimiter='; '))
+    data['main_image'] = data['images'].apply(lambda x: [i['large'] for i in x if i['variant'] == 'MAIN'])
+    data['main_image'] = data['main_image'].apply(lambda x: x[0] if len(x) > 0 else None)
+    data['text'] = data.apply(lambda x: create_text(x['title'],
+                                                    x['features_t'],
+                                                    x['description_t'],
+                                                    x['details_t'],
+                                                    x['store']), axis=1)
+    data['text'] = data['text'].apply(remove_emojis_rowwise)
+    return data
+
+
+def run(name, fn, data):
+    start = time.perf_counter()
+    out = fn(data)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<12} {len(data) / elapsed:>12,.0f} rows/s  ({elapsed:.2f}s)")
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', default=data_path)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--n_jobs', type=int, default=4)
+    args = parser.parse_args()
+
+    data = pd.read_json(args.input, lines=True, nrows=args.rows)
+    print(f"{len(data)} rows from {args.input}")
+
+    baseline = run('row-wise', build_text_columns_rowwise, data)
+    vectorized = run('vectorized', build_text_columns, data)
+    parallel = run(f'{args.n_jobs} procs', lambda d: build_text_columns(d, n_jobs=args.n_jobs), data)
+
+    same = (baseline['text'].tolist() == vectorized['text'].tolist() == parallel['text'].tolist()
+            and baseline['main_image'].tolist() == vectorized['main_image'].tolist())
+    print(f"identical output: {same}")
@@ -0,0 +1,201 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from metrics import incr
+
+
+def normalize_text(text):
+    return re.sub(r'\s+', ' ', str(text)).strip().lower()
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+class LRUCache:
+    """Thread-safe LRU cache with TTL, optionally backed by a SQLite file so it survives restarts.
+
+    Values go through ``dumps`` / ``loads`` before they are written to disk (json by default).
+    """
+
+    def __init__(self, max_size=10000, ttl=None, db_path=None, namespace='default',
+                 dumps=json.dumps, loads=json.loads, max_disk_size=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.namespace = namespace
+        self.dumps = dumps
+        self.loads = loads
+
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+
+        self._db = None
+        if db_path:
+            os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "namespace TEXT, key TEXT, value BLOB, expires_at REAL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            self._prune_disk(max_disk_size or max_size * 10)
+
+    def _expires_at(self):
+        return time.time() + self.ttl if self.ttl else None
+
+    def _prune_disk(self, max_disk_size):
+        with self._db:
+            self._db.execute("DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at < ?",
+                             (time.time(),))
+            # keep the entries that expire last
+            self._db.execute(
+                "DELETE FROM cache WHERE namespace = ? AND key NOT IN ("
+                "SELECT key FROM cache WHERE namespace = ? "
+                "ORDER BY COALESCE(expires_at, 1e18) DESC LIMIT ?)",
+                (self.namespace, self.namespace, max_disk_size),
+            )
+
+    def _put_memory(self, key, value, expires_at):
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            if key in self._data:
+                value, expires_at = self._data[key]
+                if expires_at is None or expires_at > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    incr('cache_requests_total', cache=self.namespace, result='hit')
+                    return value
+                del self._data[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?",
+                    (self.namespace, key),
+                ).fetchone()
+                if row is not None and (row[1] is None or row[1] > now):
+                    value = self.loads(row[0])
+                    self._put_memory(key, value, row[1])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    incr('cache_requests_total', cache=self.namespace, result='disk_hit')
+                    return value
+
+            self.misses += 1
+            incr('cache_requests_total', cache=self.namespace, result='miss')
+            return default
+
+    def set(self, key, value):
+        expires_at = self._expires_at()
+        with self._lock:
+            self._put_memory(key, value, expires_at)
+            if self._db is not None:
+                with self._db:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                        (self.namespace, key, self.dumps(value), expires_at),
+                    )
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            if self._db is not None:
+                with self._db:
+                    self._db.execute("DELETE FROM cache WHERE namespace = ? AND key = ?",
+                                     (self.namespace, key))
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            if self._db is not None:
+                with self._db:
+                    self._db.execute("DELETE FROM cache WHERE namespace = ?", (self.namespace,))
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'disk_hits': self.disk_hits,
+                'hit_rate': self.hits / total if total else 0.0,
+                'size': len(self._data),
+            }
+
+
+class CachedEncoder:
+    """Text model wrapper that looks up the embeddings of known texts instead of encoding them.
+
+    Query keywords come from a small vocabulary, so most encodes become cache hits. The cache
+    key includes model_name and the encode options that change the output (e.g.
+    normalize_embeddings), so a different model or option never reuses old embeddings.
+    """
+
+    def __init__(self, model, cache, model_name=''):
+        self.model = model
+        self.cache = cache
+        self.model_name = model_name
+
+    # encode options that only change how the output is computed, not the vectors
+    IGNORED_OPTIONS = ('show_progress_bar',)
+
+    def _key(self, text, options=''):
+        return f"{self.model_name}:{options}{normalize_text(text)}"
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        options = {k: v for k, v in kwargs.items() if k not in self.IGNORED_OPTIONS}
+        # the default options keep the plain keys, so existing cache entries stay valid
+        options = json.dumps(options, sort_keys=True, default=str) + ':' if options else ''
+
+        vectors = [self.cache.get(self._key(t, options)) for t in texts]
+        # misses are encoded together in one forward pass
+        misses = list(dict.fromkeys(t for t, v in zip(texts, vectors) if v is None))
+        if misses:
+            encoded = np.asarray(self.model.encode(misses, batch_size=batch_size, **kwargs), dtype=np.float32)
+            encoded = dict(zip(misses, encoded.reshape(len(misses), -1)))
+            for t in misses:
+                self.cache.set(self._key(t, options), encoded[t])
+            vectors = [encoded[t] if v is None else v for t, v in zip(texts, vectors)]
+
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        out = np.vstack(vectors).astype(np.float32, copy=False)
+        return out[0] if single else out
+
+    def preload(self, texts):
+        # e.g. the subcategory names, the most frequent keywords
+        self.encode(list(texts))
+
+    def __getattr__(self, name):
+        # everything else (tokenizer, device, ...) comes from the wrapped model
+        if name == 'model':
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+
+def embedding_cache(max_size=50000, db_path=None, namespace='keyword_embedding'):
+    # LRU cache of float32 vectors, stored as raw bytes in SQLite
+    return LRUCache(max_size=max_size, db_path=db_path, namespace=namespace,
+                    dumps=lambda v: np.asarray(v, dtype=np.float32).tobytes(),
+                    loads=lambda b: np.frombuffer(b, dtype=np.float32))
@@ -0,0 +1,104 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from metadata_store import write_metadata_store_chunks
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def asin_digest(parent_asins):
+    h = hashlib.sha256()
+    for asin in parent_asins:
+        h.update(str(asin).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class ShardCheckpoint:
+    """Embedding shards of an index build kept on disk, so a restarted build skips finished shards.
+
+    A shard is identified by its batch number and the digest of its input parent_asins; the
+    fingerprint (models, mixing ratios, ...) invalidates every shard when the build settings change.
+    """
+
+    def __init__(self, checkpoint_dir, fingerprint):
+        self.checkpoint_dir = checkpoint_dir
+        self.fingerprint = fingerprint
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        self.manifest = {'fingerprint': fingerprint, 'shards': {}}
+        manifest_path = os.path.join(checkpoint_dir, MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get('fingerprint') == fingerprint:
+                self.manifest = manifest
+            else:
+                print("Build settings changed, existing shards are ignored.")
+
+    def _file(self, name):
+        return os.path.join(self.checkpoint_dir, name)
+
+    def _write_manifest(self):
+        tmp_path = self._file(MANIFEST_NAME + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self._file(MANIFEST_NAME))
+
+    def is_done(self, shard_id, parent_asins):
+        shard = self.manifest['shards'].get(str(shard_id))
+        return (shard is not None
+                and shard['asin_digest'] == asin_digest(parent_asins)
+                and os.path.exists(self._file(shard['embeddings']))
+                and os.path.exists(self._file(shard['metadata'])))
+
+    def save_shard(self, shard_id, parent_asins, metadata, embeddings):
+        # shard files are written before the manifest entry, a crash in between
+        # only means the shard is computed again
+        embeddings_file = f'shard_{shard_id:06d}.npy'
+        metadata_file = f'shard_{shard_id:06d}.pkl'
+
+        with open(self._file(embeddings_file + '.tmp'), 'wb') as f:
+            np.save(f, np.asarray(embeddings, dtype=np.float32))
+        os.replace(self._file(embeddings_file + '.tmp'), self._file(embeddings_file))
+        metadata.to_pickle(self._file(metadata_file + '.tmp'), compression=None)
+        os.replace(self._file(metadata_file + '.tmp'), self._file(metadata_file))
+
+        self.manifest['shards'][str(shard_id)] = {
+            'asin_digest': asin_digest(parent_asins),
+            'n_rows': len(metadata),
+            'embeddings': embeddings_file,
+            'metadata': metadata_file,
+        }
+        self._write_manifest()
+
+    def assemble(self, shard_ids, path=None, metadata_path=None):
+        # one pass over the shards into a preallocated (optionally memory-mapped) matrix.
+        # With metadata_path the metadata is written shard by shard into a columnar store
+        # there instead of one DataFrame, so neither of them is held in memory
+        shards = [self.manifest['shards'][str(i)] for i in shard_ids]
+        shards = [s for s in shards if s['n_rows'] > 0]
+        if not shards:
+            return pd.DataFrame(), np.empty((0, 0), dtype=np.float32)
+
+        n_rows = sum(s['n_rows'] for s in shards)
+        dim = np.load(self._file(shards[0]['embeddings']), mmap_mode='r').shape[1]
+        if path:
+            embeddings = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(n_rows, dim))
+        else:
+            embeddings = np.empty((n_rows, dim), dtype=np.float32)
+
+        def shard_metadata():
+            row = 0
+            for s in shards:
+                embeddings[row:row + s['n_rows']] = np.load(self._file(s['embeddings']), mmap_mode='r')
+                row += s['n_rows']
+                yield pd.read_pickle(self._file(s['metadata']), compression=None)
+
+        if metadata_path:
+            return write_metadata_store_chunks(metadata_path, shard_metadata()), embeddings
+        return pd.concat(list(shard_metadata()), ignore_index=True), embeddings
@@ -3,14 +3,71 @@ img_ratio = 0.7
 text_ratio = 0.3
 base_k = 10
 batch_size = 100
+image_download_workers = 16  # threads downloading images while the current batch is encoded
+image_prefetch_batches = 2  # batches downloaded ahead of the encoder
+image_timeout = 10  # seconds per image download
+embedding_workers = 1  # index builds: processes embedding slices in parallel, each with its own CLIP models
+embedding_threads_per_worker = None  # torch threads per worker, None splits the cores evenly
+embedding_slice_size = 2000  # rows per slice sent to a worker
+verification_workers = 8  # concurrent post-extraction check requests
+verification_timeout = 30  # seconds per post-extraction check request
+verification_max_retries = 2
+verification_target = None  # stop the relevance check once this many relevant products are confirmed, None checks all
+verification_budget_s = None  # seconds, candidates not checked by then are returned unverified, None for no limit
+verification_max_calls = None  # vision requests per query, None for no limit
+verification_batch_size = (5, 10)  # min / max images per vision request, sized from the relevance rate seen so far
+rephrase_cache_size = 10000  # in-memory LRU entries for rephrased queries
+rephrase_cache_ttl = 7 * 24 * 3600  # seconds
+verdict_cache_size = 100000  # in-memory LRU entries for (query, product) relevance verdicts
+verdict_cache_ttl = 7 * 24 * 3600  # seconds
+keyword_cache_size = 50000  # in-memory LRU entries of keyword -> text embedding, preloaded with the subcategories
+dedup_threshold = 0.95  # index builds: cosine similarity above which listings are collapsed into one product, None disables
+dedup_neighbors = 20  # neighbours searched per product when collapsing near duplicates
+fusion = 'max'  # how hits of the rephrased keywords are merged: 'max' score or 'rrf' (reciprocal rank fusion)
+
+# FAISS index type: 'flat' (exact), 'sq_fp16' / 'sq_int8' (scalar quantized), 'ivf_flat', 'ivf_pq' or 'hnsw'
+# (approximate, see benchmarks/ann_index.py)
+index_type = 'flat'
+index_params = {
+    'nlist': 1024,  # ivf: number of inverted lists
+    'pq_m': 64,  # ivf_pq: sub-quantizers, must divide the embedding dimension
+    'pq_nbits': 8,  # ivf_pq: bits per sub-quantizer
+    'hnsw_m': 32,  # hnsw: neighbours per node
+    'ef_construction': 200,  # hnsw: build-time search depth
+    'train_sample_size': 100000,  # ivf: vectors used for training
+}
+nprobe = 16  # ivf: lists visited per query
+ef_search = 64  # hnsw: query-time search depth
+rerank_factor = 4  # sq_fp16 / sq_int8 / ivf_pq: candidates per result re-scored against the full-precision vectors on disk, 1 disables
 
 # Static configuration for the OpenAI API key and model paths
 openai_api_key = 'your_openai_api_key_here'  # Replace with your actual OpenAI API key
 img_model_path = 'clip-ViT-B-32'
 text_model_path = 'sentence-transformers/clip-ViT-B-32'
+openai_base_url = None  # point at a local stub server for testing, None uses the OpenAI API
 
 index_path = './index/faiss_index.index'
-metadata_path = './index/faiss_metadata.pkl'
+# columnar, memory-mapped metadata store (folder); a path ending with .pkl uses the legacy pickle
+metadata_path = './index/faiss_metadata'
+
+# local product image cache shared by index creation and the app, None disables it
+image_cache_dir = './cache/images'
+image_cache_max_mb = 5 * 1024
+thumbnail_size = 256  # bounding box of the cached display thumbnail
+
+# on-disk store for the LLM caches so they survive restarts, None keeps them in memory only
+cache_db_path = './cache/llm_cache.sqlite'
+
+# retrieval server (server.py): concurrent searches wait up to server_batch_wait_ms to be
+# encoded and searched together, at most server_max_batch_keywords keywords per batch
+server_host = '127.0.0.1'
+server_port = 8000
+server_batch_wait_ms = 5
+server_max_batch_keywords = 64
+server_request_workers = 32  # threads running rephrasing / verification of in-flight requests
+
+# one json line per retrieval with its nested stage timings, None disables the log
+metrics_log_path = None
 
 data_path = './data/meta_Amazon_Fashion.jsonl'
 cols_to_drop = ['main_category', 'bought_together', 'categories']
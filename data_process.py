@@ -4,23 +4,28 @@ from tqdm import tqdm
 from embedding import *
 from config import *
 import re
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+# compiled once at import instead of on every row
+EMOJI_PATTERN = re.compile(
+    "["                                  
+    "\U0001F600-\U0001F64F"  # Emoticons
+    "\U0001F300-\U0001F5FF"  # Symbols & pictographs
+    "\U0001F680-\U0001F6FF"  # Transport & map symbols
+    "\U0001F1E0-\U0001F1FF"  # Flags (iOS)
+    "\U00002700-\U000027BF"  # Dingbats
+    "\U0001F900-\U0001F9FF"  # Supplemental Symbols and Pictographs
+    "\U00002600-\U000026FF"  # Misc symbols
+    "\U0001FA70-\U0001FAFF"  # Symbols and Pictographs Extended-A
+    "\U000025A0-\U000025FF"  # Geometric shapes
+    "]+", flags=re.UNICODE
+)
+WHITESPACE_PATTERN = re.compile(r'\s+')
 
 def remove_emojis(text):
-    emoji_pattern = re.compile(
-        "["                                  
-        "\U0001F600-\U0001F64F"  # Emoticons
-        "\U0001F300-\U0001F5FF"  # Symbols & pictographs
-        "\U0001F680-\U0001F6FF"  # Transport & map symbols
-        "\U0001F1E0-\U0001F1FF"  # Flags (iOS)
-        "\U00002700-\U000027BF"  # Dingbats
-        "\U0001F900-\U0001F9FF"  # Supplemental Symbols and Pictographs
-        "\U00002600-\U000026FF"  # Misc symbols
-        "\U0001FA70-\U0001FAFF"  # Symbols and Pictographs Extended-A
-        "\U000025A0-\U000025FF"  # Geometric shapes
-        "]+", flags=re.UNICODE
-    )
-    text = emoji_pattern.sub(' ', text)
-    text = re.sub(r'\s+', ' ', text)
+    text = EMOJI_PATTERN.sub(' ', text)
+    text = WHITESPACE_PATTERN.sub(' ', text)
     return text.strip()
 
 def process_list(l, delimiter=' '):
@@ -60,35 +65,65 @@ def add_category_to_text(text, category, subcategory):
     text += f"Product Subcategory: {subcategory}\n"
     return text.strip().lower()
 
-def prepare_data(input_path, 
-                 cols_to_drop, 
-                 sample_size=None):
-    
-    data = pd.read_json(input_path, lines=True)
-    
-    # process the lists and dictionaries
-    data['features_t'] = data['features'].apply(process_list)
-    data['description_t'] = data['description'].apply(process_list)
-    data['details'] = data['details'].apply(lambda x: process_details(x, details_map=details_map))
-    data['details_t'] = data['details'].apply(lambda x: proecss_dict(x, delimiter='; '))
-    data['main_image'] = data['images'].apply(lambda x: [i['large'] for i in x if i['variant'] == 'MAIN'])
-    data['main_image'] = data['main_image'].apply(lambda x: x[0] if len(x) > 0 else None)
-
-    # create the text column before embedding
-    data['text'] = data.apply(lambda x: create_text(x['title'],
-                                                    x['features_t'], 
-                                                    x['description_t'], 
-                                                    x['details_t'],
-                                                    x['store']), axis=1)
-    
-    # remove emojis and multiple spaces
-    data['text'] = data['text'].apply(remove_emojis)
+TEXT_SOURCE_COLUMNS = ['title', 'features', 'description', 'details', 'images', 'store']
+
+def text_columns(title, features, description, details, images, store):
+    # list comprehensions over the raw columns instead of row-wise .apply(axis=1),
+    # same output as process_list / process_details / proecss_dict / create_text
+    features_t = [None if l == [] else ' '.join(l) for l in features]
+    description_t = [None if l == [] else ' '.join(l) for l in description]
+    details = [{details_map[k]: v for k, v in d.items() if k in details_map} for d in details]
+    details_t = [None if d == {} else '; '.join([f"{k}: {v}" for k, v in d.items()]) for d in details]
+    main_image = [next((i['large'] for i in imgs if i['variant'] == 'MAIN'), None) for imgs in images]
+
+    # create the text column before embedding, then remove emojis and multiple spaces
+    text = [
+        remove_emojis(create_text(*fields))
+        for fields in zip(title, features_t, description_t, details_t, store)
+    ]
+    return details, main_image, text
+
+def _text_columns_worker(columns):
+    return text_columns(*columns)
+
+def build_text_columns(data, n_jobs=1, chunksize=10000):
+    columns = [data[col].tolist() for col in TEXT_SOURCE_COLUMNS]
+
+    if n_jobs > 1:
+        # only the source columns go to the workers and only the three new columns come back
+        chunks = [[col[i:i + chunksize] for col in columns] for i in range(0, len(data), chunksize)]
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(_text_columns_worker, chunks))
+        details = [x for r in results for x in r[0]]
+        main_image = [x for r in results for x in r[1]]
+        text = [x for r in results for x in r[2]]
+    else:
+        details, main_image, text = text_columns(*columns)
+
+    data = data.copy()
+    data['details'] = details
+    data['main_image'] = main_image
+    data['text'] = text
+    return data
+
+def process_chunk(data, cols_to_drop, n_jobs=1):
+    data = build_text_columns(data, n_jobs=n_jobs)
     
     # drop the necessary columns
-    data = data.drop(columns=['images', 'videos'] + cols_to_drop)
+    data = data.drop(columns=['images', 'videos'] + cols_to_drop, errors='ignore')
     
     # make sure there are both text / main images and prices
     data = data[data['text'].notna() & data['main_image'].notna() & data['price'].notna()] 
+    
+    return data
+
+def prepare_data(input_path, 
+                 cols_to_drop, 
+                 sample_size=None,
+                 n_jobs=1):
+    
+    data = pd.read_json(input_path, lines=True)
+    data = process_chunk(data, cols_to_drop, n_jobs=n_jobs)
     data = data.drop_duplicates(subset=['title'], keep='first')
     
     # used during devleopment to limit the size of the dataset
@@ -99,6 +134,43 @@ def prepare_data(input_path,
     
     return data
 
+def title_hashes(titles):
+    # 8-byte digests, the only per-product state kept across chunks
+    return [int.from_bytes(hashlib.blake2b(str(t).encode('utf-8'), digest_size=8).digest(), 'little')
+            for t in titles]
+
+def content_hashes(texts, images):
+    # changes whenever the embedded text or image of a product changes
+    return [hashlib.blake2b(f"{t}\0{u}".encode('utf-8'), digest_size=8).hexdigest()
+            for t, u in zip(texts, images)]
+
+def prepare_data_stream(input_path,
+                        cols_to_drop,
+                        chunksize=10000,
+                        n_jobs=1):
+    # same cleaning / filtering / title dedup as prepare_data, but the jsonl is read
+    # in chunks of `chunksize` lines and each processed chunk is yielded straight away
+    # sorted 8-byte title digests of the products already yielded, the only state kept
+    seen_titles = np.empty(0, dtype=np.uint64)
+    reader = pd.read_json(input_path, lines=True, chunksize=chunksize)
+    for chunk in reader:
+        data = process_chunk(chunk, cols_to_drop, n_jobs=n_jobs)
+
+        # keep the first occurrence of each title across all chunks
+        hashes = np.array(title_hashes(data['title']), dtype=np.uint64)
+        _, first = np.unique(hashes, return_index=True)
+        keep = np.zeros(len(hashes), dtype=bool)
+        keep[first] = True
+        if len(seen_titles):
+            pos = np.minimum(np.searchsorted(seen_titles, hashes), len(seen_titles) - 1)
+            keep &= seen_titles[pos] != hashes
+        # the new digests are unique and not seen yet, merged in without sorting everything again
+        new = np.sort(hashes[keep])
+        seen_titles = np.insert(seen_titles, np.searchsorted(seen_titles, new), new)
+        data = data[keep].reset_index(drop=True)
+
+        if len(data) > 0:
+            yield data
 
 def create_category(fashion_categories, text_model):
     categories = []
@@ -130,4 +202,55 @@ def find_closest_category(row, categories):
         'predicted_category': categories.loc[closest_idx, 'category'],
         'predicted_subcategory': categories.loc[closest_idx, 'subcategories'],
         'sim_scores': max(similarities)
-    })
\ No newline at end of file
+    })
+
+
+def normalize_rows(x):
+    x = np.asarray(x, dtype=np.float32)
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    return x / np.maximum(norms, 1e-12)
+
+
+class CategoryTagger:
+    """Cosine-similarity category tagging as one matrix product against all subcategory embeddings."""
+
+    def __init__(self, categories):
+        # categories: output of create_category
+        self.category = categories['category'].to_numpy()
+        self.subcategory = categories['subcategories'].to_numpy()
+        self.matrix = normalize_rows(np.vstack(categories['category_embedding'].values))
+
+    @classmethod
+    def from_model(cls, fashion_categories, text_model):
+        return cls(create_category(fashion_categories, text_model))
+
+    def scores(self, embeddings):
+        return normalize_rows(np.atleast_2d(embeddings)) @ self.matrix.T
+
+    def top_k(self, embeddings, k=1, batch_size=100000):
+        # returns (N, k) subcategory positions and cosine similarities, best first
+        embeddings = np.atleast_2d(embeddings)
+        k = min(k, len(self.matrix))
+        all_idx, all_scores = [], []
+        for i in range(0, len(embeddings), batch_size):
+            sims = self.scores(embeddings[i:i + batch_size])
+            idx = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+            top = np.take_along_axis(sims, idx, axis=1)
+            order = np.argsort(-top, axis=1)
+            all_idx.append(np.take_along_axis(idx, order, axis=1))
+            all_scores.append(np.take_along_axis(top, order, axis=1))
+        return np.vstack(all_idx), np.vstack(all_scores)
+
+    def tag(self, embeddings, batch_size=100000):
+        # best category per product, same columns as find_closest_category
+        idx, scores = self.top_k(embeddings, k=1, batch_size=batch_size)
+        return pd.DataFrame({
+            'predicted_category': self.category[idx[:, 0]],
+            'predicted_subcategory': self.subcategory[idx[:, 0]],
+            'sim_scores': scores[:, 0],
+        })
+
+    def infer(self, embedding, k=3):
+        # top k (category, subcategory, score) for a single embedding, e.g. an encoded query
+        idx, scores = self.top_k(embedding, k=k)
+        return [(self.category[i], self.subcategory[i], float(s)) for i, s in zip(idx[0], scores[0])]
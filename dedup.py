@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+import faiss
+
+from index import build_faiss_index, set_search_params
+from metadata_store import MetadataStore, write_metadata_store_chunks
+
+
+def find_representatives(D, I, threshold, priority):
+    # greedy clustering: in priority order, a product that is not yet taken becomes a
+    # representative and takes its untaken neighbours above the threshold. Every variant
+    # is similar to its own representative, so clusters do not chain across the catalog
+    n = len(I)
+    rep = np.full(n, -1, dtype=np.int64)
+    for i in priority:
+        if rep[i] >= 0:
+            continue
+        rep[i] = i
+        for j in I[i][(D[i] >= threshold) & (I[i] >= 0)]:
+            if rep[j] < 0:
+                rep[j] = i
+    return rep
+
+
+def collapse_near_duplicates(metadata, embeddings, threshold=0.95, n_neighbors=20, index_type="flat",
+                             nprobe=None, ef_search=None, base_k=10, images_per_call=5, block_size=100000,
+                             **index_params):
+    # metadata: DataFrame or MetadataStore (streamed builds) whose row i belongs to embedding row i.
+    # Products whose mixed embeddings have a cosine similarity >= threshold (colour variants,
+    # resellers, re-uploads) are collapsed into the most reviewed one, the metadata rows of
+    # the others are kept in its 'variants' column, most reviewed first, so update_index can
+    # promote one when the representative is delisted. The neighbours come from a FAISS index
+    # of the given type over the catalog itself.
+    # Returns the kept metadata, the kept embeddings (compacted in place) and a report
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    faiss.normalize_L2(embeddings)
+    n = len(embeddings)
+    k = min(max(n_neighbors, base_k) + 1, n)
+
+    print(f"Searching {k - 1} neighbours of {n} products for near duplicates...")
+    index = build_faiss_index(embeddings, index_type=index_type, **index_params)
+    set_search_params(index, nprobe=nprobe, ef_search=ef_search)
+    D = np.empty((n, k), dtype=np.float32)
+    I = np.empty((n, k), dtype=np.int64)
+    for start in range(0, n, block_size):
+        D[start:start + block_size], I[start:start + block_size] = index.search(embeddings[start:start + block_size], k)
+    del index
+
+    # the most reviewed listing of a cluster is the one shown
+    is_store = isinstance(metadata, MetadataStore)
+    reviews = metadata.column('rating_number') if is_store else metadata['rating_number'].to_numpy(dtype=np.float64)
+    reviews = np.nan_to_num(np.asarray(reviews, dtype=np.float64), nan=0.0)
+    priority = np.lexsort((np.arange(n), -reviews))
+    rep = find_representatives(D, I, threshold, priority)
+    keep = np.flatnonzero(rep == np.arange(n))
+
+    # rows of the variants of each representative, the metadata is only read when it is written
+    members = [[] for _ in range(n)]
+    for i in priority:
+        if rep[i] != i:
+            members[rep[i]].append(int(i))
+
+    report = dedup_report(D[:, :base_k], I[:, :base_k], rep, keep, members, images_per_call)
+
+    # keep is ascending, row keep[j] >= j, so the rows can be moved down in place (also in a memmap)
+    for start in range(0, len(keep), block_size):
+        block = keep[start:start + block_size]
+        embeddings[start:start + len(block)] = embeddings[block]
+    if is_store:
+        # the kept rows are copied block by block into a new store next to the input one
+        def kept_rows():
+            for start in range(0, len(keep), block_size):
+                block = keep[start:start + block_size]
+                yield pd.DataFrame(metadata.rows(block)).assign(variants=[metadata.rows(members[i]) for i in block])
+        metadata = write_metadata_store_chunks(metadata.store_path + '.dedup', kept_rows())
+    else:
+        variants = [metadata.iloc[members[i]].to_dict('records') if members[i] else [] for i in keep]
+        metadata = metadata.iloc[keep].reset_index(drop=True)
+        metadata['variants'] = variants
+    return metadata, embeddings[:len(keep)], report
+
+
+def dedup_report(D, I, rep, keep, members, images_per_call=5):
+    # index shrinkage, and how many of the top base_k hits of a product (used as a stand-in
+    # for a query) were clones of another hit, i.e. candidates the vision check saw twice
+    n = len(rep)
+    hits = I >= 0
+    n_hits = hits.sum(axis=1)
+    # distinct representatives per row: sort the hits' representatives and count the changes
+    reps = np.sort(np.where(hits, rep[np.maximum(I, 0)], -1), axis=1)
+    n_distinct = ((np.diff(reps, axis=1) != 0) & (reps[:, 1:] >= 0)).sum(axis=1) + (reps[:, 0] >= 0)
+    redundant = n_hits - n_distinct
+    cluster_sizes = np.array([len(members[i]) + 1 for i in keep])
+    return {
+        'n_before': int(n),
+        'n_after': int(len(keep)),
+        'shrinkage': float(1 - len(keep) / n) if n else 0.0,
+        'n_clusters': int((cluster_sizes > 1).sum()),
+        'max_cluster_size': int(cluster_sizes.max()) if len(cluster_sizes) else 0,
+        'redundant_candidates_per_query': float(redundant.mean()) if n else 0.0,
+        # in images_per_call sized vision requests
+        'vision_calls_saved_per_query': float(redundant.mean() / images_per_call) if n else 0.0,
+    }
+
+
+def format_report(report):
+    return (f"Near-duplicate collapsing: {report['n_before']} -> {report['n_after']} products "
+            f"({report['shrinkage']:.1%} smaller, {report['n_clusters']} clusters, largest {report['max_cluster_size']}), "
+            f"{report['redundant_candidates_per_query']:.2f} duplicate candidates and "
+            f"{report['vision_calls_saved_per_query']:.2f} vision calls saved per query")
@@ -1,8 +1,10 @@
 
 import time
+import queue
 import openai
 import faiss
 import requests
+import threading
 
 import numpy as np
 import pandas as pd
@@ -10,6 +12,9 @@ import pandas as pd
 from PIL import Image
 from io import BytesIO
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from sklearn.metrics.pairwise import cosine_similarity
 from sentence_transformers import SentenceTransformer
 
@@ -28,13 +33,116 @@ def get_clip_text_embedding(text_list, id_list, model, batch_size=100):
     df = pd.DataFrame({'parent_asin': all_ids, 'text_embedding': list(all_embeddings)})
     return df
 
-def load_image(url_or_path):
+def get_http_session(pool_size=16, retries=2):
+    # pooled connections reused across downloads, retries on connection errors / 5xx
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=Retry(total=retries, backoff_factor=0.5,
+                                            status_forcelist=[500, 502, 503, 504]))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def load_image(url_or_path, session=None, timeout=10, image_cache=None):
+    if image_cache is not None:
+        return image_cache.get_clip_image(url_or_path)
     if url_or_path.startswith("http://") or url_or_path.startswith("https://"):
-        response = requests.get(url_or_path, stream=True)
+        response = (session or requests).get(url_or_path, timeout=timeout)
+        response.raise_for_status()
         image = Image.open(BytesIO(response.content)).convert("RGB")
         return image
     else:
         return Image.open(url_or_path)
+
+class ImageLoadReport:
+    """Images that could not be downloaded, decoded or encoded during an embedding run."""
+
+    def __init__(self):
+        self.n_total = 0
+        self.n_ok = 0
+        self.failures = []
+        self._lock = threading.Lock()
+
+    def add_failure(self, position, url, stage, error):
+        with self._lock:
+            self.failures.append({
+                'position': position,
+                'url': url,
+                'stage': stage,
+                'error': f"{type(error).__name__}: {error}",
+            })
+
+    def summary(self):
+        stages = {}
+        for failure in self.failures:
+            stages[failure['stage']] = stages.get(failure['stage'], 0) + 1
+        return {'total': self.n_total, 'ok': self.n_ok, 'failed': len(self.failures), 'by_stage': stages}
+
+def iter_image_batches(image_urls, batch_size=100, max_workers=16, prefetch_batches=2,
+                       timeout=10, report=None, session=None, image_cache=None):
+    # producer / consumer: a background thread downloads and decodes the next
+    # batches with a thread pool while the caller encodes the current one.
+    # The queue holds at most `prefetch_batches` batches, which bounds memory.
+    # yields (positions, images) for every batch, positions index into image_urls
+    report = report if report is not None else ImageLoadReport()
+    session = session or get_http_session(pool_size=max_workers)
+    batches = queue.Queue(maxsize=max(1, prefetch_batches))
+    stop = threading.Event()
+    done = object()
+    errors = []
+
+    def put(item):
+        # give up when the consumer has stopped, so the thread never blocks forever
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def produce():
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                for i in range(0, len(image_urls), batch_size):
+                    if stop.is_set():
+                        break
+                    futures = []
+                    for pos in range(i, min(i + batch_size, len(image_urls))):
+                        url = image_urls[pos]
+                        if url is None or pd.isna(url):
+                            report.add_failure(pos, url, 'missing', ValueError("no image url"))
+                            continue
+                        futures.append((pos, url, pool.submit(load_image, url, session, timeout, image_cache)))
+
+                    positions, images = [], []
+                    for pos, url, future in futures:
+                        try:
+                            images.append(future.result())
+                            positions.append(pos)
+                        except Exception as e:
+                            report.add_failure(pos, url, 'load', e)
+                    put((positions, images))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            put(done)
+
+    report.n_total += len(image_urls)
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = batches.get()
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+    if errors:
+        raise errors[0]
     
 def get_clip_image_embedding(image_urls, id_list, model, batch_size=100):
     all_embeddings = []
@@ -75,3 +183,66 @@ def mix_embeddings(row, img_rato=0.75, txt_ratio=0.25):
     txt_emb = np.array(row['text_embedding'])
     return img_emb * img_rato + txt_emb * txt_ratio
 
+def allocate_matrix(n_rows, dim, path=None):
+    # contiguous float32 matrix, memory-mapped to `path` when given
+    if path:
+        return np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(n_rows, dim))
+    return np.empty((n_rows, dim), dtype=np.float32)
+
+def get_clip_text_matrix(text_list, model, batch_size=100, path=None, progress=True):
+    # row i is the embedding of text_list[i]
+    out = None
+    for i in tqdm(range(0, len(text_list), batch_size), disable=not progress):
+        batch = np.asarray(model.encode(text_list[i:i + batch_size]), dtype=np.float32)
+        if out is None:
+            out = allocate_matrix(len(text_list), batch.shape[1], path)
+        out[i:i + len(batch)] = batch
+    if out is None:
+        return np.empty((0, 0), dtype=np.float32)
+    return out
+
+def get_clip_image_matrix(image_urls, model, batch_size=100, path=None, report=None,
+                          max_workers=16, prefetch_batches=2, timeout=10, image_cache=None, progress=True):
+    # embeddings of the images that loaded are written compactly, in input order:
+    # row j of the matrix belongs to the j-th True entry of the returned mask.
+    # Failures are recorded in `report` (an ImageLoadReport)
+    report = report if report is not None else ImageLoadReport()
+    valid = np.zeros(len(image_urls), dtype=bool)
+    out = None
+    n_valid = 0
+
+    n_batches = (len(image_urls) + batch_size - 1) // batch_size
+    image_batches = iter_image_batches(image_urls,
+                                       batch_size=batch_size,
+                                       max_workers=max_workers,
+                                       prefetch_batches=prefetch_batches,
+                                       timeout=timeout,
+                                       report=report,
+                                       image_cache=image_cache)
+    for positions, images in tqdm(image_batches, total=n_batches, disable=not progress):
+        if not images:
+            continue
+        try:
+            batch = np.asarray(model.encode(images), dtype=np.float32)
+        except Exception as e:
+            for pos in positions:
+                report.add_failure(pos, image_urls[pos], 'encode', e)
+            continue
+        if out is None:
+            out = allocate_matrix(len(image_urls), batch.shape[1], path)
+        out[n_valid:n_valid + len(batch)] = batch
+        valid[positions] = True
+        n_valid += len(batch)
+
+    report.n_ok += n_valid
+    if out is None:
+        return np.empty((0, 0), dtype=np.float32), valid
+    return out[:n_valid], valid
+
+def mix_embedding_matrices(img_matrix, txt_matrix, img_ratio=0.75, txt_ratio=0.25, block_size=100000):
+    # weighted sum written into img_matrix block by block, no extra (N, d) allocation
+    for i in range(0, len(img_matrix), block_size):
+        block = img_matrix[i:i + block_size]
+        block *= img_ratio
+        block += txt_ratio * txt_matrix[i:i + block_size]
+    return img_matrix
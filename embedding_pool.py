@@ -0,0 +1,120 @@
+import os
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from tqdm import tqdm
+
+from embedding import (SentenceTransformer, ImageLoadReport, allocate_matrix,
+                       get_clip_image_matrix, get_clip_text_matrix)
+from image_cache import ImageCache
+
+# per-process state of a worker, set once by _init_worker
+_worker = {}
+
+
+def _init_worker(img_model_path, text_model_path, threads_per_worker, image_settings, image_cache_settings):
+    # each worker owns its models and limits its intra-op threads, so
+    # n_workers * threads_per_worker matches the cores of the machine
+    import torch
+    torch.set_num_threads(threads_per_worker)
+    _worker['img_model'] = SentenceTransformer(img_model_path)
+    _worker['text_model'] = (_worker['img_model'] if text_model_path == img_model_path
+                             else SentenceTransformer(text_model_path))
+    _worker['image_settings'] = image_settings
+    _worker['image_cache'] = ImageCache(**image_cache_settings) if image_cache_settings else None
+
+
+def _embed_slice(parent_asins, texts, image_urls, batch_size):
+    # image embeddings of the images that loaded and text embeddings of the same rows
+    report = ImageLoadReport()
+    img, valid = get_clip_image_matrix(image_urls, _worker['img_model'],
+                                       batch_size=batch_size,
+                                       report=report,
+                                       image_cache=_worker['image_cache'],
+                                       progress=False,
+                                       **_worker['image_settings'])
+    txt = get_clip_text_matrix([t for t, ok in zip(texts, valid) if ok], _worker['text_model'],
+                               batch_size=batch_size, progress=False)
+    return parent_asins, np.ascontiguousarray(img), valid, np.ascontiguousarray(txt), report.failures
+
+
+class EmbeddingPool:
+    """Process pool for CPU index builds, every worker loads its own CLIP models.
+
+    The catalog is cut into slices of `slice_size` rows that are embedded in parallel; the
+    results are collected in input order and checked against the slice's parent_asins.
+    """
+
+    def __init__(self, n_workers, img_model_path, text_model_path, threads_per_worker=None,
+                 slice_size=2000, batch_size=100, max_download_workers=16, prefetch_batches=2,
+                 timeout=10, image_cache_settings=None):
+        self.n_workers = n_workers
+        self.slice_size = slice_size
+        self.batch_size = batch_size
+        threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // n_workers)
+        image_settings = {'max_workers': max_download_workers,
+                          'prefetch_batches': prefetch_batches,
+                          'timeout': timeout}
+        # spawn: torch is not fork safe once its thread pools are started
+        self.executor = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(img_model_path, text_model_path, threads_per_worker, image_settings, image_cache_settings),
+        )
+
+    def embed(self, parent_asins, texts, image_urls, report=None, img_path=None, text_path=None):
+        # same contract as get_clip_image_matrix: row j of both matrices belongs to the
+        # j-th True entry of the returned mask. Failures are recorded in `report`
+        report = report if report is not None else ImageLoadReport()
+        report.n_total += len(image_urls)
+        n = len(parent_asins)
+        starts = list(range(0, n, self.slice_size))
+
+        def submit(start):
+            end = start + self.slice_size
+            return self.executor.submit(_embed_slice, list(parent_asins[start:end]), list(texts[start:end]),
+                                        list(image_urls[start:end]), self.batch_size)
+
+        # at most two slices per worker in flight, finished slices wait for the ones before them.
+        # a slice's future is dropped once it is copied out, its arrays are not kept until the end
+        in_flight = 2 * self.n_workers
+        futures = deque(submit(start) for start in starts[:in_flight])
+        valid = np.zeros(n, dtype=bool)
+        img_out, txt_out = None, None
+        n_valid = 0
+        for i, start in enumerate(tqdm(starts)):
+            if i + in_flight < len(starts):
+                futures.append(submit(starts[i + in_flight]))
+            slice_asins, img, slice_valid, txt, failures = futures.popleft().result()
+            if slice_asins != list(parent_asins[start:start + self.slice_size]):
+                raise RuntimeError(f"Embedding slice starting at row {start} came back for other products")
+
+            for failure in failures:
+                report.failures.append({**failure, 'position': failure['position'] + start})
+            valid[start:start + len(slice_valid)] = slice_valid
+            if len(img) == 0:
+                continue
+            if img_out is None:
+                img_out = allocate_matrix(n, img.shape[1], img_path)
+                txt_out = allocate_matrix(n, txt.shape[1], text_path)
+            img_out[n_valid:n_valid + len(img)] = img
+            txt_out[n_valid:n_valid + len(txt)] = txt
+            n_valid += len(img)
+
+        report.n_ok += n_valid
+        if img_out is None:
+            empty = np.empty((0, 0), dtype=np.float32)
+            return empty, valid, empty
+        return img_out[:n_valid], valid, txt_out[:n_valid]
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,127 @@
+import numbers
+
+import faiss
+import numpy as np
+import pandas as pd
+
+from metadata_store import MetadataStore
+
+# filters: {'store': [...], 'category': [...], 'subcategory': [...],
+#           'price': (min, max), 'rating_number': (min, max), 'average_rating': (min, max)}
+CATEGORICAL_FILTERS = ['store', 'category', 'subcategory']
+RANGE_FILTERS = ['price', 'rating_number', 'average_rating']
+
+
+def validate_filters(filters):
+    # raises ValueError for filters that MetadataFilter.mask would reject
+    if filters is None:
+        return
+    if not isinstance(filters, dict):
+        raise ValueError("filters must be a mapping of column to condition")
+    for col, condition in filters.items():
+        if col not in CATEGORICAL_FILTERS + RANGE_FILTERS:
+            raise ValueError(f"Unknown filter: {col}")
+        if condition is None:
+            continue
+        if col in CATEGORICAL_FILTERS:
+            # a bare string would be matched character by character
+            if not isinstance(condition, (list, tuple)):
+                raise ValueError(f"{col} filter must be a list of values")
+        elif (not isinstance(condition, (list, tuple)) or len(condition) != 2 or
+              not all(b is None or (isinstance(b, numbers.Real) and not isinstance(b, bool)) for b in condition)):
+            raise ValueError(f"{col} filter must be [min, max] with numbers or null")
+
+
+class MetadataFilter:
+    """Per-attribute arrays over the metadata rows, turned into FAISS id selectors at query time."""
+
+    def __init__(self, metadata):
+        self.n_rows = len(metadata)
+        self.codes = {}
+        self.dictionary = {}
+        self.values = {}
+
+        if isinstance(metadata, MetadataStore):
+            for col in CATEGORICAL_FILTERS:
+                if col in metadata.schema:
+                    codes, dictionary = metadata.column(col)
+                    self._set_categorical(col, np.asarray(codes), dictionary)
+            for col in RANGE_FILTERS:
+                if col in metadata.schema:
+                    self.values[col] = np.asarray(metadata.column(col), dtype=np.float64)
+        else:
+            # legacy pickled list of dicts
+            data = pd.DataFrame(metadata)
+            for col in CATEGORICAL_FILTERS:
+                if col in data.columns:
+                    codes, dictionary = pd.factorize(data[col], use_na_sentinel=True)
+                    self._set_categorical(col, codes.astype(np.int32), dictionary)
+            for col in RANGE_FILTERS:
+                if col in data.columns:
+                    self.values[col] = pd.to_numeric(data[col], errors='coerce').to_numpy(dtype=np.float64)
+
+    def _set_categorical(self, col, codes, dictionary):
+        self.codes[col] = codes
+        self.dictionary[col] = {str(v): i for i, v in enumerate(dictionary)}
+
+    def options(self, col):
+        # values available for a categorical filter, e.g. to fill a multiselect
+        return sorted(self.dictionary.get(col, {}).keys())
+
+    def bounds(self, col):
+        values = self.values[col]
+        return float(np.nanmin(values)), float(np.nanmax(values))
+
+    def mask(self, filters):
+        # boolean mask over metadata rows, None when nothing is filtered
+        if not filters:
+            return None
+        validate_filters(filters)
+        mask = None
+        for col, condition in filters.items():
+            if condition is None:
+                continue
+            if col in CATEGORICAL_FILTERS:
+                if col not in self.codes:
+                    continue
+                allowed = [self.dictionary[col][str(v)] for v in condition if str(v) in self.dictionary[col]]
+                col_mask = np.isin(self.codes[col], np.array(allowed, dtype=np.int32))
+            else:
+                if col not in self.values:
+                    continue
+                low, high = condition
+                values = self.values[col]
+                col_mask = np.ones(self.n_rows, dtype=bool)
+                if low is not None:
+                    col_mask &= values >= low
+                if high is not None:
+                    col_mask &= values <= high
+            mask = col_mask if mask is None else mask & col_mask
+        return mask
+
+    def search_params(self, index, filters):
+        # faiss SearchParameters restricting the search to the rows that pass the filters,
+        # None when nothing is filtered. Returns (params, number of selected rows)
+        mask = self.mask(filters)
+        if mask is None:
+            return None, self.n_rows
+
+        n_selected = int(mask.sum())
+        bitmap = np.packbits(mask, bitorder='little')
+        selector = faiss.IDSelectorBitmap(self.n_rows, faiss.swig_ptr(bitmap))
+
+        inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+        if isinstance(inner, faiss.IndexIVF):
+            # fewer matching products per list, so visit more lists to still fill top-k
+            selectivity = max(n_selected / max(self.n_rows, 1), 1e-3)
+            nprobe = int(min(inner.nlist, np.ceil(inner.nprobe / np.sqrt(selectivity))))
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=nprobe)
+        elif isinstance(inner, faiss.IndexHNSW):
+            params = faiss.SearchParametersHNSW(sel=selector, efSearch=inner.hnsw.efSearch)
+        else:
+            params = faiss.SearchParameters(sel=selector)
+
+        # the selector only points at the bitmap, keep it alive as long as params
+        params.bitmap = bitmap
+        params.selector = selector
+        return params, n_selected
@@ -0,0 +1,143 @@
+import os
+import hashlib
+import tempfile
+import threading
+from io import BytesIO
+from collections import OrderedDict
+
+import requests
+from PIL import Image
+
+
+class ImageCache:
+    """On-disk product image cache keyed by url hash, shared by index creation and the UI.
+
+    Each url is stored twice: the original bytes used for embedding, so cached and uncached
+    builds give the same embeddings, and a small display thumbnail. The least recently used
+    files are evicted once the cache grows over max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=5 * 1024 ** 3, thumb_size=256, session=None, timeout=10):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.thumb_size = thumb_size
+        self.session = session or requests.Session()
+        self.timeout = timeout
+
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        # path -> size in least recently used order, scanned once and then kept up to date.
+        # Files written by other processes sharing the folder are picked up at their next start
+        self._entries = self._scan()
+        self._size = sum(self._entries.values())
+
+    def _path(self, url, kind):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        name = f"{key}.orig" if kind == 'clip' else f"{key}.thumb.jpg"
+        return os.path.join(self.cache_dir, key[:2], name)
+
+    def _scan(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+        entries.sort()
+        return OrderedDict((path, size) for _, path, size in entries)
+
+    def _write_atomic(self, path, write):
+        # write to a temporary file in the same folder and rename it into place,
+        # readers never see a partially written image
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return os.path.getsize(path)
+
+    def _fetch(self, url):
+        if url.startswith("http://") or url.startswith("https://"):
+            response = self.session.get(url, timeout=self.timeout)
+            response.raise_for_status()
+            content = response.content
+        else:
+            with open(url, 'rb') as f:
+                content = f.read()
+        thumbnail = Image.open(BytesIO(content)).convert("RGB")
+        thumbnail.thumbnail((self.thumb_size, self.thumb_size))
+
+        written = {}
+        clip_path = self._path(url, 'clip')
+        written[clip_path] = self._write_atomic(clip_path, lambda f: f.write(content))
+        thumb_path = self._path(url, 'thumb')
+        written[thumb_path] = self._write_atomic(thumb_path, lambda f: thumbnail.save(f, format='JPEG', quality=90))
+        with self._lock:
+            for path, size in written.items():
+                self._size += size - self._entries.pop(path, 0)
+                self._entries[path] = size
+            over = self._size > self.max_bytes
+        if over:
+            self.evict()
+
+    def get_path(self, url, kind='thumb'):
+        # kind: 'clip' (original bytes) or 'thumb'. Downloads both versions on a miss
+        path = self._path(url, kind)
+        if os.path.exists(path):
+            # the modification time keeps the recency across restarts
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+            else:
+                with self._lock:
+                    self.hits += 1
+                    if path in self._entries:
+                        self._entries.move_to_end(path)
+                return path
+
+        with self._lock:
+            self.misses += 1
+        self._fetch(url)
+        return path
+
+    def get_clip_image(self, url):
+        # decoded exactly like an uncached download in embedding.load_image
+        with open(self.get_path(url, 'clip'), 'rb') as f:
+            return Image.open(BytesIO(f.read())).convert("RGB")
+
+    def get_thumbnail(self, url):
+        with Image.open(self.get_path(url, 'thumb')) as image:
+            return image.convert("RGB")
+
+    def evict(self, target_ratio=0.9):
+        # delete the least recently used files until the cache is under target_ratio * max_bytes,
+        # so the next eviction only runs after another (1 - target_ratio) * max_bytes of writes
+        target = self.max_bytes * target_ratio
+        with self._lock:
+            victims = []
+            while self._entries and self._size > target:
+                path, size = self._entries.popitem(last=False)
+                self._size -= size
+                victims.append(path)
+        for path in victims:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size_bytes': self._size, 'n_files': len(self._entries)}
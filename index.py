@@ -1,41 +1,228 @@
+import os
+import time
+import uuid
+import random
+import threading
+import contextvars
 import faiss
 import pickle
 import numpy as np
 import pandas as pd
 import openai
-from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from metadata_store import load_metadata, save_metadata
+from cache import LRUCache, normalize_text, hash_text
+from filters import MetadataFilter
+from metrics import span, incr
 
-def save_faiss_index_and_metadata(index_path, metadata_path, embeddings, metadata):
-    # Normalize embeddings for cosine similarity if needed
-    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
-    normalized_embeddings = embeddings / norms
+# index types whose codes lose precision, their full-precision vectors are kept
+# in a memory-mapped file next to the index to re-rank the first-pass candidates
+LOSSY_INDEX_TYPES = ("ivf_pq", "sq_fp16", "sq_int8")
 
-    # Build index
-    dim = normalized_embeddings.shape[1]
-    index = faiss.IndexFlatIP(dim)  # inner product = cosine similarity
-    index.add(normalized_embeddings.astype("float32"))
+def _training_sample(embeddings, train_sample_size):
+    n = len(embeddings)
+    if n > train_sample_size:
+        sample = np.sort(np.random.default_rng(42).choice(n, train_sample_size, replace=False))
+        return embeddings[sample]
+    return embeddings
 
-    # Save index and metadata
-    faiss.write_index(index, index_path)
-    with open(metadata_path, "wb") as f:
-        pickle.dump(metadata, f)
+def build_faiss_index(embeddings, index_type="flat", nlist=1024, pq_m=64, pq_nbits=8,
+                      hnsw_m=32, ef_construction=200, train_sample_size=100000):
+    # embeddings: normalized float32 matrix, id i is row i.
+    # index_type: flat (exact), sq_fp16 / sq_int8 (scalar quantized, 2x / 4x smaller),
+    # ivf_flat, ivf_pq or hnsw (approximate)
+    n, dim = embeddings.shape
+    ids = np.arange(n, dtype="int64")
+    
+    if index_type in ("ivf_flat", "ivf_pq"):
+        # faiss wants ~39 training points per list, small catalogs get fewer lists
+        nlist = max(1, min(nlist, n // 39))
+        quantizer = faiss.IndexFlatIP(dim)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, pq_nbits, faiss.METRIC_INNER_PRODUCT)
+        
+        # train on a sample of the catalog
+        index.train(_training_sample(embeddings, train_sample_size))
+        # lookup by id, needed for reconstruct / compaction
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        index.add_with_ids(embeddings, ids)
+        return index
+    
+    if index_type == "hnsw":
+        hnsw = faiss.IndexHNSWFlat(dim, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        hnsw.hnsw.efConstruction = ef_construction
+        index = faiss.IndexIDMap2(hnsw)
+    elif index_type == "flat":
+        index = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))  # inner product = cosine similarity
+    elif index_type in ("sq_fp16", "sq_int8"):
+        qtype = faiss.ScalarQuantizer.QT_fp16 if index_type == "sq_fp16" else faiss.ScalarQuantizer.QT_8bit
+        sq = faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_INNER_PRODUCT)
+        # int8 learns the value range of every dimension
+        sq.train(_training_sample(embeddings, train_sample_size))
+        index = faiss.IndexIDMap2(sq)
+    else:
+        raise ValueError(f"Unknown index type: {index_type}")
+    index.add_with_ids(embeddings, ids)
+    return index
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    # query-time speed / recall trade-off of the approximate indexes
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    if isinstance(index, faiss.IndexIVF) and nprobe:
+        index.nprobe = nprobe
+    if isinstance(index, faiss.IndexHNSW) and ef_search:
+        index.hnsw.efSearch = ef_search
+
+def save_faiss_index_and_metadata(index_path, metadata_path, embeddings, metadata, index_type="flat", **index_params):
+    # Normalize embeddings for cosine similarity, in place when they already
+    # are a contiguous float32 matrix so no copy of the catalog is made
+    normalized_embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    faiss.normalize_L2(normalized_embeddings)
+
+    # Build index, ids are the metadata row numbers so products can be
+    # removed / added later without a rebuild
+    index = build_faiss_index(normalized_embeddings, index_type=index_type, **index_params)
+
+    # Save index and metadata to temporary files first and swap them in, so a
+    # running Retriever never picks up a half-written index. Row numbers change
+    # between builds, so both carry the same build id: the metadata store in its
+    # manifest, the index in a small file written after the index is swapped in.
+    # A reader that sees different ids caught a rebuild half way and loads again
+    build_id = uuid.uuid4().hex
+    faiss.write_index(index, index_path + ".tmp")
+    if index_type in LOSSY_INDEX_TYPES:
+        write_full_vectors(vectors_path(index_path) + ".new", normalized_embeddings)
+    save_metadata(metadata_path, metadata, build_id=build_id)
+    # the vectors are numbered like the index, they are swapped in last together with it
+    if index_type in LOSSY_INDEX_TYPES:
+        os.replace(vectors_path(index_path) + ".new", vectors_path(index_path))
+    elif os.path.exists(vectors_path(index_path)):
+        os.remove(vectors_path(index_path))
+    os.replace(index_path + ".tmp", index_path)
+    write_build_id(index_path, None if metadata_path.endswith('.pkl') else build_id)
 
     print(f"Saved FAISS index to {index_path} and metadata to {metadata_path}")
+
+def vectors_path(index_path):
+    return index_path + ".vectors.f32"
+
+def build_id_path(index_path):
+    return index_path + ".build_id"
+
+def write_build_id(index_path, build_id):
+    path = build_id_path(index_path)
+    if build_id is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path + ".tmp", "w") as f:
+        f.write(build_id)
+    os.replace(path + ".tmp", path)
+
+def read_build_id(index_path):
+    # None for indexes saved before build ids (and with pickled metadata)
+    try:
+        with open(build_id_path(index_path)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def write_full_vectors(path, embeddings, append=False):
+    # raw float32 rows, row i is the normalized vector of id i. Updates append
+    # the rows of new metadata ids at the end of the file
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    if append:
+        with open(path, "ab") as f:
+            f.write(embeddings.tobytes())
+        return
+    with open(path + ".tmp", "wb") as f:
+        f.write(embeddings.tobytes())
+    os.replace(path + ".tmp", path)
+
+def load_full_vectors(path, dim):
+    # memory-mapped, only the rows of re-ranked candidates are read from disk
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    n_rows = os.path.getsize(path) // (4 * dim)
+    return np.memmap(path, dtype="float32", mode="r", shape=(n_rows, dim))
+
+def rerank(query_vecs, I, vectors, k):
+    # exact scores of the first-pass candidates against the full-precision vectors,
+    # returns the top k per query in the (D, I) layout of index.search
+    D_out = np.full((len(I), k), -np.inf, dtype="float32")
+    I_out = np.full((len(I), k), -1, dtype="int64")
+    for row, (query_vec, ids) in enumerate(zip(query_vecs, I)):
+        # sorted ids read the memory-mapped file front to back
+        ids = np.sort(ids[(ids >= 0) & (ids < len(vectors))])
+        scores = vectors[ids] @ query_vec
+        top = np.argsort(-scores, kind="stable")[:k]
+        D_out[row, :len(top)] = scores[top]
+        I_out[row, :len(top)] = ids[top]
+    return D_out, I_out
+
+def write_faiss_index(index, index_path):
+    faiss.write_index(index, index_path + ".tmp")
+    os.replace(index_path + ".tmp", index_path)
+
+def as_id_mapped(index):
+    # indexes built before ids were used: position i becomes id i
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIVF)):
+        return index
+    vectors = index.reconstruct_n(0, index.ntotal)
+    id_mapped = faiss.IndexIDMap2(faiss.IndexFlatIP(index.d))
+    id_mapped.add_with_ids(vectors, np.arange(index.ntotal, dtype="int64"))
+    return id_mapped
+
+def supports_removal(index):
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    return not isinstance(inner, faiss.IndexHNSW)
+
+def live_ids(index):
+    # metadata rows that are still searchable
+    if isinstance(index, faiss.IndexIVF):
+        invlists = index.invlists
+        ids = [
+            faiss.rev_swig_ptr(invlists.get_ids(l), invlists.list_size(l)).copy()
+            for l in range(index.nlist) if invlists.list_size(l) > 0
+        ]
+        return np.concatenate(ids).astype("int64") if ids else np.empty(0, dtype="int64")
+    return faiss.vector_to_array(index.id_map).astype("int64")
     
-def rephrase_query_for_embedding(user_query, system_prompt=None):
-    system_prompt = system_prompt or (
-        """You are a product search assistant for fashion products.
-        Your task is to convert the user's query to product descriptions which are relevant to the original query
-        e.g., if the user query is "I need an outfit to go to the beach this summer", you should return "swimwear|||sandals|||sunglasses".
-        
-        output should be delimitered by |||
-        output should contain maximum 5 items
-        if the user query is already a product description, you should return it as is.
-        if the user query is not relevant to fashion products, you should return "not relevant to fashion products".
-        """
-    )
+REPHRASE_SYSTEM_PROMPT = (
+    """You are a product search assistant for fashion products.
+    Your task is to convert the user's query to product descriptions which are relevant to the original query
+    e.g., if the user query is "I need an outfit to go to the beach this summer", you should return "swimwear|||sandals|||sunglasses".
+    
+    output should be delimitered by |||
+    output should contain maximum 5 items
+    if the user query is already a product description, you should return it as is.
+    if the user query is not relevant to fashion products, you should return "not relevant to fashion products".
+    """
+)
+
+def rephrase_query_for_embedding(user_query, system_prompt=None, cache=None, client=None):
+    system_prompt = system_prompt or REPHRASE_SYSTEM_PROMPT
+
+    # repeated queries (including "not relevant" verdicts) skip the LLM call
+    if cache is not None:
+        cache_key = f"{hash_text(system_prompt)}:{normalize_text(user_query)}"
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    incr('llm_calls_total', kind='rephrase')
+    result = _rephrase_with_llm(user_query, system_prompt, client=client)
+    if cache is not None:
+        cache.set(cache_key, result)
+    return result
 
-    response = openai.chat.completions.create(
+def _rephrase_with_llm(user_query, system_prompt, client=None):
+    # the shared client carries the configured base_url and timeout
+    client = client or get_openai_client(openai.api_key)
+    response = client.chat.completions.create(
         model="gpt-4.1",
         messages=[
             {"role": "system", "content": system_prompt},
@@ -52,8 +239,26 @@ def rephrase_query_for_embedding(user_query, system_prompt=None):
     # Split by comma and strip whitespace
     return [item.strip() for item in result.split('|||')]
 
-def post_extraction_check(image_dict, query, openai_api_key):
-    client = openai.OpenAI(api_key=openai_api_key)
+# bounded, clients of keys / endpoints that are no longer used are dropped
+_openai_clients = LRUCache(max_size=16, namespace='openai_clients')
+_openai_clients_lock = threading.Lock()
+
+def get_openai_client(openai_api_key, base_url=None, timeout=30.0):
+    # one client (and connection pool) per key / endpoint, shared by all threads.
+    # retries are handled by verify_candidates so the client itself does not retry
+    key = (openai_api_key, base_url, timeout)
+    with _openai_clients_lock:
+        client = _openai_clients.get(key)
+        if client is None:
+            client = openai.OpenAI(api_key=openai_api_key,
+                                   base_url=base_url,
+                                   timeout=timeout,
+                                   max_retries=0)
+            _openai_clients.set(key, client)
+        return client
+
+def post_extraction_check(image_dict, query, openai_api_key, client=None):
+    client = client or get_openai_client(openai_api_key)
 
     # Build content list for messages
     message_content = []
@@ -103,6 +308,165 @@ def post_extraction_check(image_dict, query, openai_api_key):
 
     return [item.strip() for item in response.output_text.split('|||')]
 
+def check_batch_with_retry(batch_dict, query, openai_api_key, client=None, max_retries=2, backoff=0.5):
+    with span('verify_batch', size=len(batch_dict)) as batch_span:
+        for attempt in range(max_retries + 1):
+            incr('llm_calls_total', kind='verification')
+            try:
+                return post_extraction_check(batch_dict, query, openai_api_key, client=client)
+            except Exception:
+                batch_span.set(attempts=attempt + 1)
+                if attempt == max_retries:
+                    raise
+                incr('verification_retries_total')
+                # exponential backoff with jitter
+                time.sleep(backoff * (2 ** attempt) * (1 + random.random()))
+
+def verify_candidates(
+    check_dict,
+    query,
+    openai_api_key,
+    client=None,
+    batch_size=5,
+    max_workers=8,
+    max_retries=2,
+    backoff=0.5,
+    verdict_cache=None,
+    on_verdicts=None,
+    target=None,
+    budget_s=None,
+    max_calls=None,
+    max_batch_size=None,
+):
+    # check_dict: parent_asin -> image url, in score order. Batches are sent concurrently,
+    # at most max_workers requests in flight. on_verdicts({parent_asin: relevant}) is
+    # called in this thread with the cached verdicts and then as every batch completes.
+    # target: stop once this many relevant products are confirmed, the batches are sized
+    # (batch_size to max_batch_size images) from the relevance rate seen so far.
+    # budget_s / max_calls: wall-clock and vision-request budget, candidates that were not
+    # checked when it runs out are returned as unverified.
+    # returns (relevant, unverified) parent_asins in candidate order
+    keys = list(check_dict.keys())
+    max_batch_size = max(batch_size, max_batch_size or batch_size)
+    deadline = time.perf_counter() + budget_s if budget_s is not None else None
+
+    # known verdicts are reused, only the misses go to the vision model.
+    # the image url is part of the key so a new main_image invalidates the verdict
+    verdicts = {}
+    cache_keys = {}
+    if verdict_cache is not None:
+        query_key = normalize_text(query)
+        cache_keys = {k: f"{query_key}:{k}:{hash_text(str(check_dict[k]))}" for k in keys}
+        for k in keys:
+            cached = verdict_cache.get(cache_keys[k])
+            if cached is not None:
+                verdicts[k] = cached
+    pending = [k for k in keys if k not in verdicts]
+    if on_verdicts is not None and verdicts:
+        on_verdicts(dict(verdicts))
+
+    def check(batch):
+        relevant_batch = set(check_batch_with_retry(batch, query, openai_api_key, client,
+                                                    max_retries, backoff) or [])
+        batch_verdicts = {k: k in relevant_batch for k in batch}
+        # cached here so verdicts of batches that finish after the budget are kept too
+        if verdict_cache is not None:
+            for k, relevant in batch_verdicts.items():
+                verdict_cache.set(cache_keys[k], relevant)
+        return batch_verdicts
+
+    def next_batches(n_free, n_in_flight):
+        # candidates to send now: all of them without a target, otherwise enough to reach
+        # it at the observed relevance rate (starting from 1/2) on top of the in-flight ones
+        if target is None:
+            return [pending[i:i + batch_size] for i in range(0, min(len(pending), n_free * batch_size), batch_size)]
+        checked = [v for v in verdicts.values() if v is not None]
+        rate = (sum(checked) + 1) / (len(checked) + 2)
+        missing = target - sum(checked) - rate * n_in_flight
+        n = min(len(pending), int(np.ceil(missing / rate)))
+        if n <= 0:
+            return []
+        size = int(min(max(np.ceil(n / n_free), batch_size), max_batch_size))
+        return [pending[i:i + size] for i in range(0, min(n, n_free * size), size)]
+
+    stop_reason = None
+    failed = set()
+    n_calls = 0
+    executor = None
+    futures = {}
+    try:
+        while True:
+            if target is not None and sum(1 for v in verdicts.values() if v) >= target:
+                stop_reason = 'target'
+                break
+            # no new batches once the budget is spent, e.g. by a slow on_verdicts callback
+            if deadline is not None and time.perf_counter() >= deadline:
+                stop_reason = 'budget'
+                break
+            n_free = max_workers - len(futures)
+            if max_calls is not None:
+                n_free = min(n_free, max_calls - n_calls)
+            if pending and n_free > 0:
+                for batch_keys in next_batches(n_free, sum(len(b) for b in futures.values())):
+                    batch = {k: check_dict[k] for k in batch_keys}
+                    if executor is None:
+                        client = client or get_openai_client(openai_api_key)
+                        executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+                    # each batch runs in a copy of the current context, its span nests under the caller's
+                    futures[executor.submit(contextvars.copy_context().run, check, batch)] = batch
+                    pending = pending[len(batch_keys):]
+                    n_calls += 1
+            if not futures:
+                if pending:
+                    stop_reason = 'calls'
+                break
+
+            timeout = max(0.0, deadline - time.perf_counter()) if deadline is not None else None
+            done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                stop_reason = 'budget'
+                break
+            for future in done:
+                batch = futures.pop(future)
+                try:
+                    batch_verdicts = future.result()
+                except Exception as e:
+                    # failed batches are not cached so they are retried next time
+                    incr('failed_batches_total')
+                    print(f"Batch {keys.index(next(iter(batch)))} has issue from post extraction check: {e}")
+                    failed.update(batch)
+                    batch_verdicts = {k: False for k in batch}
+                else:
+                    verdicts.update(batch_verdicts)
+                if on_verdicts is not None:
+                    on_verdicts(batch_verdicts)
+    finally:
+        if executor is not None:
+            # batches still running past the budget finish in the background
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    if stop_reason is not None:
+        incr('verification_early_stops_total', reason=stop_reason)
+    # keep the candidate order so the output does not depend on timing.
+    # after an early stop for the target the unchecked candidates are simply not needed
+    relevant = [k for k in keys if verdicts.get(k)]
+    unverified = [] if stop_reason == 'target' else [k for k in keys if k not in verdicts and k not in failed]
+    return relevant, unverified
+
+def load_faiss_index_and_metadata(index_path, metadata_path, full_vectors=False):
+    # full_vectors: also map the full-precision vectors (None without them) and return
+    # (index, metadata, vectors). A rebuild swaps the metadata in before the vectors and
+    # the index, so both are opened before the metadata
+    with span('index_load', index_path=index_path, metadata_path=metadata_path) as s:
+        index = faiss.read_index(index_path)
+        vectors = load_full_vectors(vectors_path(index_path), index.d) if full_vectors else None
+        metadata = load_metadata(metadata_path)
+        s.set(n_vectors=index.ntotal)
+    
+    if full_vectors:
+        return index, metadata, vectors
+    return index, metadata
+
 def query_faiss_index(
     index_path,
     metadata_path,
@@ -110,76 +474,172 @@ def query_faiss_index(
     text_model,
     openai_api_key,
     base_k=10,
+    fusion="max",
+    filters=None,
+    verify_target=None,
+    verify_budget_s=None,
 ):
 
     # Load FAISS index and metadata
-    print(f"Loading FAISS index from {index_path} and metadata from {metadata_path}")
-    index = faiss.read_index(index_path)
-    with open(metadata_path, "rb") as f:
-        metadata = pickle.load(f)
-    print("FAISS index and metadata loaded successfully.")
+    index, metadata = load_faiss_index_and_metadata(index_path, metadata_path)
     
+    return search_faiss_index(
+        index,
+        metadata,
+        orig_query_text,
+        text_model,
+        openai_api_key,
+        base_k=base_k,
+        fusion=fusion,
+        filters=filters,
+        verify_target=verify_target,
+        verify_budget_s=verify_budget_s,
+    )
+
+def fuse_search_results(D, I, fusion="max", rrf_k=60):
+    # D, I: (n_keywords, k) scores and ids from one multi-row index.search
+    ranks = np.broadcast_to(np.arange(I.shape[1]), I.shape)
+    valid = I >= 0
+    ids, scores, ranks = I[valid], D[valid], ranks[valid]
+    if ids.size == 0:
+        return ids, scores
+
+    if fusion == "max":
+        # best score of each product over all keywords
+        order = np.argsort(-scores, kind="stable")
+        uniq_ids, first = np.unique(ids[order], return_index=True)
+        fused = scores[order][first]
+    elif fusion == "rrf":
+        # reciprocal rank fusion, sum of 1 / (rrf_k + rank) over keywords
+        uniq_ids, inverse = np.unique(ids, return_inverse=True)
+        fused = np.bincount(inverse, weights=1.0 / (rrf_k + ranks + 1))
+    else:
+        raise ValueError(f"Unknown fusion rule: {fusion}")
+
+    order = np.argsort(-fused, kind="stable")
+    return uniq_ids[order], fused[order]
+
+def search_faiss_index(
+    index,
+    metadata,
+    orig_query_text,
+    text_model,
+    openai_api_key,
+    base_k=10,
+    fusion="max",
+    client=None,
+    max_workers=8,
+    max_retries=2,
+    rephrase_cache=None,
+    verdict_cache=None,
+    filters=None,
+    metadata_filter=None,
+    full_vectors=None,
+    rerank_factor=4,
+    search_batcher=None,
+    on_candidates=None,
+    on_verdicts=None,
+    verify_target=None,
+    verify_budget_s=None,
+    verify_max_calls=None,
+    verify_batch_size=(5, 5),
+):
+    # filters: store / category / subcategory value lists and price / rating_number /
+    # average_rating (min, max) ranges, applied inside the FAISS search (see filters.py)
+    # full_vectors: full-precision vectors of a quantized index (load_full_vectors), the
+    # first pass fetches rerank_factor * base_k candidates that are re-scored exactly
+    # search_batcher: callable (index, keywords, k, params) -> (query_vecs, D, I) that encodes
+    # and searches together with other concurrent queries (see server.py)
+    # on_candidates(DataFrame) gets the FAISS hits before verification and on_verdicts
+    # the relevance verdicts as they come in, e.g. to render results progressively
+    # verify_target / verify_budget_s / verify_max_calls: see verify_candidates, the candidates
+    # left unchecked by the budget are returned after the relevant ones with verified=False
     
+    if client is None and openai_api_key:
+        client = get_openai_client(openai_api_key)
+
     # rephrase the query if necessary
-    print(f"Rephrasing original query: {orig_query_text}")
-    query_text = rephrase_query_for_embedding(orig_query_text)
+    with span('rephrase') as s:
+        query_text = rephrase_query_for_embedding(orig_query_text, cache=rephrase_cache, client=client)
+        s.set(keywords=query_text)
     if query_text == "not relevant to fashion products":
         return pd.DataFrame()
     
-    print(f"Rephrased query: {query_text}")
-    res_list = []
-    
-    # for each key word in the query, we will search for the most relevant products
-    print('Starting search for each keyword in the query...')
-    for kw in query_text:
-        # Embed the query
-        query_vec = text_model.encode(kw).astype("float32").reshape(1, -1)
-
-        # Perform search
-        D, I = index.search(query_vec, base_k)
-
-        # Build result list
-        kw_list = [
-            {**metadata[i], "score": float(D[0][rank])}
-            for rank, i in enumerate(I[0])
+    # embed all key words in one forward pass and search them in one call
+    if search_batcher is None:
+        with span('encode', n_keywords=len(query_text)):
+            query_vecs = np.ascontiguousarray(
+                text_model.encode(query_text, batch_size=len(query_text)), dtype="float32"
+            ).reshape(len(query_text), -1)
+    with span('search', k=base_k) as s:
+        candidate_k = base_k * rerank_factor if full_vectors is not None else base_k
+        params = None
+        if filters:
+            metadata_filter = metadata_filter or MetadataFilter(metadata)
+            params, n_selected = metadata_filter.search_params(index, filters)
+            s.set(n_selected=n_selected)
+        if search_batcher is not None:
+            query_vecs, D, I = search_batcher(index, query_text, candidate_k, params)
+        elif params is not None:
+            D, I = index.search(query_vecs, candidate_k, params=params)
+        else:
+            D, I = index.search(query_vecs, candidate_k)
+        if full_vectors is not None:
+            with span('rerank', n_candidates=candidate_k):
+                D, I = rerank(query_vecs, I, full_vectors, base_k)
+
+        # merge the per-keyword hits into one ranked list of unique products
+        ids, scores = fuse_search_results(D, I, fusion=fusion)
+        res_list = [
+            {**metadata[i], "score": float(score)}
+            for i, score in zip(ids, scores)
         ]
-        res_list.extend(kw_list)
-    print(f"Found {len(res_list)} results for the query.")
+        s.set(n_candidates=len(res_list))
+    if on_candidates is not None:
+        on_candidates(pd.DataFrame(res_list))
     
     # post-extraction check for relevance
-    print("Performing post-extraction relevance check...")
-    check_dict = {}
-    for res in res_list:
-        # Use the image URL as the key and store the ID
-        check_dict[res["parent_asin"]] = res["main_image"]
-    
-    relevant_images = []
-    for i in tqdm(range(0, len(check_dict), 5)):
-        batch_dict = {k: check_dict[k] for k in list(check_dict.keys())[i:i+5]}
-        try:
-            relevant_images_batch = post_extraction_check(batch_dict, orig_query_text, openai_api_key)
-            if relevant_images_batch:
-                relevant_images.extend(relevant_images_batch)
-        except Exception as e:
-            print(f"Batch {i} has issue from post extraction check: {e}")
-            
-    print(f"Found {len(relevant_images)} relevant images after post-extraction check.")
-    print("Filtering and sorting results...")
-    # Filter out non-relevant results
-    final_res = []
-    for res in res_list:
-        if res['parent_asin'] in relevant_images:
-            final_res.append(res)
-    print(f"Filtered down to {len(final_res)} results after relevance check.")
+    with span('verify') as s:
+        check_dict = {}
+        for res in res_list:
+            # Use the image URL as the key and store the ID
+            check_dict[res["parent_asin"]] = res["main_image"]
+        
+        relevant_images, unverified_images = verify_candidates(
+            check_dict,
+            orig_query_text,
+            openai_api_key,
+            client=client,
+            batch_size=verify_batch_size[0],
+            max_batch_size=verify_batch_size[1],
+            max_workers=max_workers,
+            max_retries=max_retries,
+            verdict_cache=verdict_cache,
+            on_verdicts=on_verdicts,
+            target=verify_target,
+            budget_s=verify_budget_s,
+            max_calls=verify_max_calls,
+        )
+        s.set(n_candidates=len(check_dict), n_relevant=len(relevant_images), n_unverified=len(unverified_images))
     
-    if len(final_res) == 0:
-        print("No relevant results found after filtering. Returning empty DataFrame.")
-        return pd.DataFrame()
+    with span('assemble') as s:
+        # Filter out non-relevant results
+        relevant_images, unverified_images = set(relevant_images), set(unverified_images)
+        final_res = []
+        for res in res_list:
+            if res['parent_asin'] in relevant_images:
+                final_res.append({**res, "verified": True})
+            elif res['parent_asin'] in unverified_images:
+                final_res.append({**res, "verified": False})
         
-    # Sort by score, remove duplicates from multiple queries
-    final_res = sorted(final_res, key=lambda x: x["score"], reverse=True)
-    final_res = pd.DataFrame(final_res)
-    final_res = final_res.drop(columns=['score']).drop_duplicates(subset=['title']).reset_index(drop=True)
+        if len(final_res) == 0:
+            s.set(n_results=0)
+            return pd.DataFrame()
+            
+        # Sort by score with the verified products first, remove duplicates from multiple queries
+        final_res = sorted(final_res, key=lambda x: (x["verified"], x["score"]), reverse=True)
+        final_res = pd.DataFrame(final_res)
+        final_res = final_res.drop(columns=['score']).drop_duplicates(subset=['title']).reset_index(drop=True)
+        s.set(n_results=len(final_res))
     
-    print(f"Complete!")
     return final_res
@@ -1,64 +1,371 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
 from data_process import *
 from embedding import *
 from config import *
 from index import *
+from retriever import Retriever
+from image_cache import ImageCache
+from embedding_pool import EmbeddingPool
+from dedup import collapse_near_duplicates, format_report
+from checkpoint import ShardCheckpoint, asin_digest
+from metadata_store import append_metadata_rows, resolve_metadata_path
 
-def index_creation(sample_size=None):
-    print("Preparing data...")
-    data = prepare_data(data_path, cols_to_drop=cols_to_drop, sample_size=sample_size)
-    print(f"Data loaded with {len(data)} records.")
-    
-    print("Load multimodal embedding models...")
-    img_model = SentenceTransformer(img_model_path)
-    text_model = SentenceTransformer(text_model_path)
+metadata_columns = ['parent_asin', 
+                    'title', 'store', 'features', 'description', 'details',
+                    'category', 'subcategory', 
+                    'average_rating', 'rating_number', 'price', 
+                    'main_image', 'content_hash']
+
+def get_image_cache():
+    # shared with the streamlit app, images already seen are not downloaded again
+    if not image_cache_dir:
+        return None
+    return ImageCache(image_cache_dir,
+                      max_bytes=image_cache_max_mb * 1024 ** 2,
+                      thumb_size=thumbnail_size,
+                      session=get_http_session(pool_size=image_download_workers),
+                      timeout=image_timeout)
+
+def get_embedding_pool():
+    # worker processes with their own CLIP models, None embeds in this process
+    if embedding_workers <= 1:
+        return None
+    image_cache_settings = None
+    if image_cache_dir:
+        image_cache_settings = {'cache_dir': image_cache_dir,
+                                'max_bytes': image_cache_max_mb * 1024 ** 2,
+                                'thumb_size': thumbnail_size,
+                                'timeout': image_timeout}
+    return EmbeddingPool(embedding_workers, img_model_path, text_model_path,
+                         threads_per_worker=embedding_threads_per_worker,
+                         slice_size=embedding_slice_size,
+                         batch_size=batch_size,
+                         max_download_workers=image_download_workers,
+                         prefetch_batches=image_prefetch_batches,
+                         timeout=image_timeout,
+                         image_cache_settings=image_cache_settings)
+
+def embed_and_tag(data, img_model, text_model, tagger, mmap_dir=None, image_cache=None, pool=None):
+    # returns the metadata and a contiguous float32 embedding matrix, row i of
+    # the matrix belongs to row i of the metadata
+    image_path = os.path.join(mmap_dir, 'embeddings.npy') if mmap_dir else None
+    text_path = os.path.join(mmap_dir, 'text_embeddings.npy') if mmap_dir else None
+    report = ImageLoadReport()
     
-    print("Creating text embeddings...")
-    text_embeddings = get_clip_text_embedding(data['text'].tolist(),
-                                              data['parent_asin'].tolist(), 
-                                              text_model, 
-                                              batch_size=batch_size)
+    if pool is not None:
+        # images and texts of every slice are embedded together in the worker processes
+        print(f"Creating image and text embeddings with {pool.n_workers} worker processes...")
+        embeddings, valid, text_embeddings = pool.embed(data['parent_asin'].tolist(),
+                                                        data['text'].tolist(),
+                                                        data['main_image'].tolist(),
+                                                        report=report,
+                                                        img_path=image_path,
+                                                        text_path=text_path)
+    else:
+        print("Creating image embeddings...")
+        embeddings, valid = get_clip_image_matrix(data['main_image'].tolist(), 
+                                                  img_model,
+                                                  batch_size=batch_size,
+                                                  path=image_path,
+                                                  report=report,
+                                                  max_workers=image_download_workers,
+                                                  prefetch_batches=image_prefetch_batches,
+                                                  timeout=image_timeout,
+                                                  image_cache=image_cache)
+        text_embeddings = None
+    print(f"Image embedding report: {report.summary()}")
+    data = data[valid].reset_index(drop=True)
+    if len(data) == 0:
+        print("No image could be embedded.")
+        return data.assign(category=None, subcategory=None, content_hash=None)[metadata_columns], embeddings
     
-    print("Creating image embeddings...")
-    image_embeddings = get_clip_image_embedding(data['main_image'].tolist(), 
-                                                data['parent_asin'].tolist(), 
-                                                img_model,
-                                                batch_size=batch_size)
+    if text_embeddings is None:
+        print("Creating text embeddings...")
+        text_embeddings = get_clip_text_matrix(data['text'].tolist(),
+                                               text_model, 
+                                               batch_size=batch_size,
+                                               path=text_path)
 
     print("Mixing embeddings...")
-    merged_embeddings = pd.merge(image_embeddings, text_embeddings, on='parent_asin', how='inner')
-    merged_embeddings['mixed_embedding'] = merged_embeddings.apply(lambda x: mix_embeddings(x, img_ratio, text_ratio), axis=1)
-    data = data.merge(merged_embeddings, on='parent_asin', how='inner')
+    embeddings = mix_embedding_matrices(embeddings, text_embeddings, img_ratio, text_ratio)
+    del text_embeddings
+    if text_path:
+        os.remove(text_path)
     
     print("Tag categories...")
-    categories = create_category(fashion_categories, text_model)
-    data[['category', 'subcategory', 'sim_scores']] = data.apply(lambda x: find_closest_category(x, categories), axis=1)
+    tags = tagger.tag(embeddings)
+    data['category'] = tags['predicted_category'].values
+    data['subcategory'] = tags['predicted_subcategory'].values
+    data['content_hash'] = content_hashes(data['text'], data['main_image'])
     
-    print("Data preparation complete. Saving index to disk...")
-    data = data[['parent_asin', 
-                'title', 'store', 'features', 'description', 'details',
-                'category', 'subcategory', 
-                'average_rating', 'rating_number', 'price', 
-                'main_image', 
-                'mixed_embedding']]
+    return data[metadata_columns], embeddings
+
+def build_fingerprint():
+    # settings that change the embeddings, shards built with other settings are not reused
+    # 'original-images': shards embedded from the old resized cache copies are not reused
+    return asin_digest([img_model_path, text_model_path, img_ratio, text_ratio, 'original-images',
+                        json.dumps(fashion_categories, sort_keys=True)])
+
+def _embed_catalog(img_model, text_model, tagger, image_cache, pool,
+                   sample_size, stream, chunksize, mmap_dir, checkpoint_dir):
+    if not stream and checkpoint_dir is None:
+        print("Preparing data...")
+        data = prepare_data(data_path, cols_to_drop=cols_to_drop, sample_size=sample_size)
+        print(f"Data loaded with {len(data)} records.")
+        return embed_and_tag(data, img_model, text_model, tagger, mmap_dir=mmap_dir,
+                             image_cache=image_cache, pool=pool)
+    
+    if stream:
+        # read, clean and embed the catalog chunk by chunk, only the
+        # embeddings and the final metadata columns are kept
+        print(f"Streaming data in chunks of {chunksize} records...")
+        shards = prepare_data_stream(data_path, cols_to_drop=cols_to_drop, chunksize=chunksize)
+    else:
+        print("Preparing data...")
+        data = prepare_data(data_path, cols_to_drop=cols_to_drop, sample_size=sample_size)
+        print(f"Data loaded with {len(data)} records.")
+        shards = (data.iloc[i:i + chunksize].reset_index(drop=True) for i in range(0, len(data), chunksize))
+    
+    # every finished shard is written to disk, so memory does not grow with the catalog.
+    # With a checkpoint_dir the shards are kept and a restarted build skips the ones that
+    # are already done, otherwise they go to a temporary folder next to the index
+    shard_dir = checkpoint_dir or tempfile.mkdtemp(prefix='shards_', dir=mmap_dir or os.path.dirname(os.path.abspath(index_path)))
+    checkpoint = ShardCheckpoint(shard_dir, build_fingerprint())
+    try:
+        n_shards = 0
+        for i, chunk in enumerate(shards):
+            n_shards = i + 1
+            if checkpoint.is_done(i, chunk['parent_asin']):
+                print(f"Chunk {i}: already embedded, skipping")
+                continue
+            print(f"Chunk {i}: {len(chunk)} records")
+            input_asins = chunk['parent_asin'].tolist()
+            chunk, chunk_embeddings = embed_and_tag(chunk, img_model, text_model, tagger,
+                                                    image_cache=image_cache, pool=pool)
+            checkpoint.save_shard(i, input_asins, chunk, chunk_embeddings)
+        
+        # assembled into a memory-mapped matrix and a metadata store built next to the
+        # final one, save_faiss_index_and_metadata swaps the store in
+        print(f"Assembling {n_shards} shards...")
+        return checkpoint.assemble(range(n_shards),
+                                   path=build_embeddings_path(mmap_dir),
+                                   metadata_path=metadata_path + '.build')
+    finally:
+        if checkpoint_dir is None:
+            shutil.rmtree(shard_dir, ignore_errors=True)
+
+def build_embeddings_path(mmap_dir=None):
+    return os.path.join(mmap_dir, 'embeddings.npy') if mmap_dir else index_path + '.embeddings.npy'
+
+def index_creation(sample_size=None, stream=False, chunksize=10000, mmap_dir=None, checkpoint_dir=None):
+    print("Load multimodal embedding models...")
+    img_model = SentenceTransformer(img_model_path)
+    text_model = SentenceTransformer(text_model_path)
+    tagger = CategoryTagger.from_model(fashion_categories, text_model)
+    image_cache = get_image_cache()
+    # with embedding_workers > 1 the embeddings are computed by worker processes
+    pool = get_embedding_pool()
+    if mmap_dir:
+        os.makedirs(mmap_dir, exist_ok=True)
+    
+    try:
+        metadata, embeddings = _embed_catalog(img_model, text_model, tagger, image_cache, pool,
+                                              sample_size, stream, chunksize, mmap_dir, checkpoint_dir)
+    finally:
+        if pool is not None:
+            pool.close()
+    
+    if dedup_threshold is not None and len(metadata) > 1:
+        # one representative per cluster of near-identical listings, the others become its variants
+        metadata, embeddings, report = collapse_near_duplicates(metadata, embeddings,
+                                                                threshold=dedup_threshold,
+                                                                n_neighbors=dedup_neighbors,
+                                                                index_type=index_type,
+                                                                nprobe=nprobe,
+                                                                ef_search=ef_search,
+                                                                base_k=base_k,
+                                                                **index_params)
+        print(format_report(report))
     
+    print("Data preparation complete. Saving index to disk...")
     save_faiss_index_and_metadata(
         index_path,
         metadata_path,
-        embeddings=np.vstack(data["mixed_embedding"].values),
-        metadata=data.drop(columns=["mixed_embedding"]).to_dict(orient="records")
+        embeddings=embeddings,
+        metadata=metadata,
+        index_type=index_type,
+        **index_params
     )
+    # build files of streamed / checkpointed builds
+    if not mmap_dir and os.path.exists(build_embeddings_path()):
+        os.remove(build_embeddings_path())
+    shutil.rmtree(metadata_path + '.build', ignore_errors=True)
     
-def retrieve(query_text, openai_api_key, base_k=base_k):
-    print("Querying FAISS index...")
-    text_model = SentenceTransformer(text_model_path)
+# updates and compactions rewrite the same files, one at a time
+_index_write_lock = threading.Lock()
+
+def compact_index():
+    # rewrite the index and metadata with only the live rows, dropping the
+    # rows left behind by deleted and updated products
+    with _index_write_lock:
+        index, metadata = load_faiss_index_and_metadata(index_path, metadata_path)
+        ids = np.sort(live_ids(as_id_mapped(index)))
+        print(f"Compacting index: {len(ids)} live rows out of {len(metadata)}")
+        # quantized indexes only reconstruct approximations, use the full-precision copy
+        full_vectors = load_full_vectors(vectors_path(index_path), index.d)
+        embeddings = np.asarray(full_vectors[ids]) if full_vectors is not None else index.reconstruct_batch(ids)
+        rows = pd.DataFrame(metadata.rows(ids))
+        save_faiss_index_and_metadata(index_path, metadata_path, embeddings=embeddings, metadata=rows,
+                                      index_type=index_type, **index_params)
+
+def update_index(delta_jsonl, compact_threshold=0.2, background_compaction=True):
+    # delta_jsonl: products in the meta_Amazon_Fashion.jsonl schema to add or update,
+    # and lines like {"parent_asin": "...", "deleted": true} for delisted products
+    if resolve_metadata_path(metadata_path).endswith('.pkl'):
+        raise ValueError("update_index needs the columnar metadata store, convert the pickle first")
+
+    with _index_write_lock:
+        index, metadata = load_faiss_index_and_metadata(index_path, metadata_path)
+        index = as_id_mapped(index)
+        
+        # parent_asin -> row of the live products
+        ids = live_ids(index)
+        asin_to_row = {metadata.value('parent_asin', int(i)): int(i) for i in ids}
+        
+        delta = pd.read_json(delta_jsonl, lines=True)
+        is_deleted = delta['deleted'].fillna(False).astype(bool) if 'deleted' in delta.columns else pd.Series(False, index=delta.index)
+        # listings collapsed into a live representative by dedup: representative -> variant rows
+        variants = {}
+        if 'variants' in metadata.schema:
+            for asin, row in asin_to_row.items():
+                rows = metadata.value('variants', row)
+                if rows:
+                    variants[asin] = rows
+        variant_of = {v['parent_asin']: asin for asin, rows in variants.items() for v in rows}
+        deleted = [a for a in delta.loc[is_deleted, 'parent_asin'] if a in asin_to_row or a in variant_of]
+        
+        upserts = delta[~is_deleted].drop(columns=['deleted'], errors='ignore')
+        refreshed = {}
+        if len(upserts) > 0:
+            upserts = process_chunk(upserts, cols_to_drop)
+            upserts = upserts.drop_duplicates(subset=['parent_asin'], keep='last').reset_index(drop=True)
+            
+            # only new products and products whose text or image changed are embedded again,
+            # the others keep their vector and get a new metadata row if any other field changed
+            upserts['content_hash'] = content_hashes(upserts['text'], upserts['main_image'])
+            same_content = np.array([
+                asin in asin_to_row and metadata.value('content_hash', asin_to_row[asin]) == h
+                for asin, h in zip(upserts['parent_asin'], upserts['content_hash'])
+            ], dtype=bool)
+            for fresh in upserts[same_content].to_dict('records'):
+                row = asin_to_row[fresh['parent_asin']]
+                # the tags come from the unchanged embedding
+                fresh = {col: fresh.get(col) for col in metadata_columns if col not in ('category', 'subcategory')}
+                if metadata.differs(row, fresh):
+                    refreshed[row] = fresh
+            upserts = upserts[~same_content].reset_index(drop=True)
+        
+        # embedded before anything is removed, products whose new image fails to load
+        # keep their old row and vector
+        rows = None
+        if len(upserts) > 0:
+            print("Load multimodal embedding models...")
+            img_model = SentenceTransformer(img_model_path)
+            text_model = SentenceTransformer(text_model_path)
+            tagger = CategoryTagger.from_model(fashion_categories, text_model)
+            rows, embeddings = embed_and_tag(upserts, img_model, text_model, tagger, image_cache=get_image_cache())
+        embedded = set(rows['parent_asin']) if rows is not None else set()
+        
+        # a deleted variant leaves its representative, an updated one is indexed on its own
+        # like any new product. The representative keeps its vector and gets a new row
+        for asin in [a for a in deleted if a in variant_of] + [a for a in embedded if a in variant_of]:
+            rep = variant_of[asin]
+            variants[rep] = [v for v in variants[rep] if v['parent_asin'] != asin]
+            if rep not in deleted and rep not in embedded:
+                refreshed.setdefault(asin_to_row[rep], {})['variants'] = variants[rep]
+        
+        # a deleted representative hands over to its most reviewed variant, which keeps the
+        # representative's vector and tags until its own next delta line (empty content_hash)
+        promoted = {asin_to_row[rep]: {**variants[rep][0], 'variants': variants[rep][1:], 'content_hash': ''}
+                    for rep in deleted if rep in asin_to_row and variants.get(rep)}
+        deleted_rows = [asin_to_row[a] for a in deleted if a in asin_to_row]
+        print(f"Delta: {len(embedded)} new or changed products ({len(upserts) - len(embedded)} kept as they were, "
+              f"their image failed), {len(refreshed)} metadata-only updates, "
+              f"{len(deleted)} deleted products ({len(promoted)} replaced by a variant)")
+        
+        # row i of the full-precision file (quantized indexes) is metadata row i
+        full_vectors = load_full_vectors(vectors_path(index_path), index.d)
+        if full_vectors is not None and len(full_vectors) != len(metadata):
+            raise ValueError("Full-precision vectors are out of sync with the metadata, rebuild the index")
+        
+        new_rows, new_vectors = [], []
+        kept = [(row, {**metadata[row], **fresh}) for row, fresh in refreshed.items()] + list(promoted.items())
+        if kept:
+            # read the kept vectors before their old ids are removed
+            old_rows = np.array([row for row, _ in kept], dtype="int64")
+            new_rows.append(pd.DataFrame([new_row for _, new_row in kept]))
+            new_vectors.append(np.asarray(full_vectors[old_rows]) if full_vectors is not None else index.reconstruct_batch(old_rows))
+        
+        remove = deleted_rows + list(refreshed) + [asin_to_row[a] for a in embedded if a in asin_to_row]
+        if remove:
+            if not supports_removal(index):
+                raise ValueError(f"The {index_type} index does not support removing products, rebuild it with index_creation")
+            index.remove_ids(np.array(remove, dtype="int64"))
+        
+        if embedded:
+            if 'variants' in metadata.schema:
+                # updated representatives keep their variants
+                rows['variants'] = [variants.get(a, []) for a in rows['parent_asin']]
+            embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+            faiss.normalize_L2(embeddings)
+            new_rows.append(rows)
+            new_vectors.append(embeddings)
+        
+        n_added = 0
+        if new_rows:
+            # metadata first, the index never points at rows that do not exist yet
+            row_ids = append_metadata_rows(metadata_path, pd.concat(new_rows, ignore_index=True))
+            embeddings = np.ascontiguousarray(np.vstack(new_vectors), dtype="float32")
+            if full_vectors is not None:
+                write_full_vectors(vectors_path(index_path), embeddings, append=True)
+            index.add_with_ids(embeddings, row_ids)
+            n_added = len(row_ids)
+        
+        write_faiss_index(index, index_path)
+        garbage = 1 - index.ntotal / max(len(metadata) + n_added, 1)
+        print(f"Index updated: {index.ntotal} live products, {garbage:.1%} of metadata rows are stale")
     
-    results = query_faiss_index(
-        index_path,
-        metadata_path,
+    if garbage > compact_threshold:
+        if background_compaction:
+            thread = threading.Thread(target=compact_index, daemon=False)
+            thread.start()
+            return thread
+        compact_index()
+
+_retriever = None
+
+def get_retriever(openai_api_key=None):
+    # load the model, index and metadata once per process and keep them warm
+    global _retriever
+    if _retriever is None:
+        _retriever = Retriever(index_path=index_path,
+                               metadata_path=metadata_path,
+                               text_model_path=text_model_path,
+                               openai_api_key=openai_api_key)
+    return _retriever
+
+def retrieve(query_text, openai_api_key, base_k=base_k, filters=None):
+    retriever = get_retriever(openai_api_key)
+    
+    results = retriever.search(
         query_text,
-        text_model,
-        openai_api_key,
+        openai_api_key=openai_api_key,
         base_k=base_k,
+        filters=filters,
     )
     
-    return results
\ No newline at end of file
+    return results
@@ -0,0 +1,418 @@
+import os
+import json
+import shutil
+import pickle
+
+import numpy as np
+import pandas as pd
+
+# Storage layout of each metadata column
+#   float / int : one numeric .npy column
+#   category    : int32 codes (-1 = missing) + dictionary kept in the manifest
+#   text        : utf-8 blob + int64 offsets
+#   json        : same as text, each value json encoded (lists and dicts)
+# Columns missing from the schema are stored as json.
+METADATA_SCHEMA = {
+    'parent_asin': 'text',
+    'title': 'text',
+    'store': 'category',
+    'features': 'json',
+    'description': 'json',
+    'details': 'json',
+    'category': 'category',
+    'subcategory': 'category',
+    'average_rating': 'float',
+    'rating_number': 'int',
+    'price': 'float',
+    'main_image': 'text',
+    'content_hash': 'text',
+    'variants': 'json',
+}
+
+MANIFEST_NAME = 'manifest.json'
+SEGMENTS_NAME = 'segments.json'
+
+
+def _json_default(o):
+    # numpy arrays / scalars coming out of pandas
+    if hasattr(o, 'tolist'):
+        return o.tolist()
+    return str(o)
+
+
+def _encode_values(values, kind):
+    if kind == 'json':
+        return [json.dumps(v, default=_json_default).encode('utf-8') for v in values]
+    return [('' if v is None or (isinstance(v, float) and np.isnan(v)) else str(v)).encode('utf-8')
+            for v in values]
+
+
+def stored_value(value, kind):
+    # the value read back after writing `value` into a column of the given kind
+    if kind in ('float', 'int'):
+        number = pd.to_numeric(pd.Series([value], dtype=object), errors='coerce').iloc[0]
+        if kind == 'int':
+            return 0 if pd.isna(number) else int(number)
+        return float(number)
+    if kind == 'category':
+        return None if value is None or (isinstance(value, float) and np.isnan(value)) else str(value)
+    raw = _encode_values([value], kind)[0].decode('utf-8')
+    return json.loads(raw) if kind == 'json' else raw
+
+
+def _raw_to_npy(raw_path, npy_path, dtype):
+    # raw little-endian values written chunk by chunk become a .npy file
+    dtype = np.dtype(dtype)
+    n = os.path.getsize(raw_path) // dtype.itemsize
+    with open(npy_path, 'wb') as out, open(raw_path, 'rb') as raw:
+        np.lib.format.write_array_header_1_0(out, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                   'fortran_order': False, 'shape': (n,)})
+        shutil.copyfileobj(raw, out, 1024 ** 2)
+    os.remove(raw_path)
+
+
+class MetadataStoreWriter:
+    """Writes one store segment a DataFrame at a time, appending to the column files.
+
+    Only the current chunk and the category dictionaries are in memory; close() swaps the
+    finished folder in. Columns missing from a chunk are stored as missing values.
+    """
+
+    def __init__(self, store_path, schema=METADATA_SCHEMA):
+        self.store_path = store_path
+        self.schema = schema
+        self.n_rows = 0
+        self.columns = {}
+        self._files = {}
+        self._dictionaries = {}
+        self._blob_sizes = {}
+
+        # write into a temporary folder and swap it in at the end
+        self.tmp_path = store_path + '.tmp'
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+
+    def _file(self, name):
+        return os.path.join(self.tmp_path, name)
+
+    def _add_column(self, col):
+        kind = self.schema.get(col, 'json')
+        self.columns[col] = {'kind': kind}
+        if kind in ('float', 'int'):
+            self._files[col] = [open(self._file(f'{col}.npy.raw'), 'wb')]
+        elif kind == 'category':
+            self._files[col] = [open(self._file(f'{col}.codes.npy.raw'), 'wb')]
+            self._dictionaries[col] = {}
+        else:
+            offsets = open(self._file(f'{col}.offsets.npy.raw'), 'wb')
+            offsets.write(np.zeros(1, dtype=np.int64).tobytes())
+            self._files[col] = [offsets, open(self._file(f'{col}.blob'), 'wb')]
+            self._blob_sizes[col] = 0
+        # rows written before the column first showed up
+        self._write(col, pd.Series([None] * self.n_rows, dtype=object))
+
+    def _write(self, col, values):
+        kind = self.columns[col]['kind']
+        files = self._files[col]
+        if kind == 'float':
+            files[0].write(pd.to_numeric(values, errors='coerce').to_numpy(dtype=np.float64).tobytes())
+        elif kind == 'int':
+            files[0].write(pd.to_numeric(values, errors='coerce').fillna(0).to_numpy(dtype=np.int64).tobytes())
+        elif kind == 'category':
+            # chunk codes are mapped onto the dictionary shared by all chunks, -1 stays missing
+            codes, uniques = pd.factorize(values, use_na_sentinel=True)
+            lookup = self._dictionaries[col]
+            remap = np.array([lookup.setdefault(str(u), len(lookup)) for u in uniques] + [-1], dtype=np.int32)
+            files[0].write(remap[codes].tobytes())
+        else:
+            encoded = _encode_values(values.tolist(), kind)
+            offsets = self._blob_sizes[col] + np.cumsum([len(b) for b in encoded], dtype=np.int64)
+            files[0].write(offsets.tobytes())
+            files[1].write(b''.join(encoded))
+            self._blob_sizes[col] = int(offsets[-1]) if len(offsets) else self._blob_sizes[col]
+
+    def append(self, data):
+        if not isinstance(data, pd.DataFrame):
+            data = pd.DataFrame(data)
+        for col in data.columns:
+            if col not in self.columns:
+                self._add_column(col)
+        for col in self.columns:
+            values = data[col] if col in data.columns else pd.Series([None] * len(data), dtype=object)
+            self._write(col, values)
+        self.n_rows += len(data)
+
+    def close(self, build_id=None):
+        for col, spec in self.columns.items():
+            for f in self._files[col]:
+                f.close()
+            kind = spec['kind']
+            if kind in ('float', 'int'):
+                _raw_to_npy(self._file(f'{col}.npy.raw'), self._file(f'{col}.npy'),
+                            np.float64 if kind == 'float' else np.int64)
+            elif kind == 'category':
+                _raw_to_npy(self._file(f'{col}.codes.npy.raw'), self._file(f'{col}.codes.npy'), np.int32)
+                spec['dictionary'] = list(self._dictionaries[col])
+            else:
+                _raw_to_npy(self._file(f'{col}.offsets.npy.raw'), self._file(f'{col}.offsets.npy'), np.int64)
+
+        with open(self._file(MANIFEST_NAME), 'w') as f:
+            json.dump({'n_rows': self.n_rows, 'columns': self.columns, 'build_id': build_id}, f)
+
+        _swap_in(self.tmp_path, self.store_path)
+
+
+def write_metadata_store(store_path, data, schema=METADATA_SCHEMA, build_id=None):
+    writer = MetadataStoreWriter(store_path, schema)
+    writer.append(data)
+    writer.close(build_id)
+
+
+def _swap_in(tmp_path, store_path):
+    # swap the folders, readers holding the old mmaps keep working
+    old_path = store_path + '.old'
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+    if os.path.exists(store_path):
+        os.replace(store_path, old_path)
+    os.replace(tmp_path, store_path)
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+
+class _Segment:
+    # one folder written by write_metadata_store
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        with open(os.path.join(store_path, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+        self.n_rows = manifest['n_rows']
+        self.schema = manifest['columns']
+        self.build_id = manifest.get('build_id')
+
+        self._arrays = {}
+        for col, spec in self.schema.items():
+            kind = spec['kind']
+            if kind in ('float', 'int'):
+                self._arrays[col] = np.load(self._file(f'{col}.npy'), mmap_mode='r')
+            elif kind == 'category':
+                self._arrays[col] = np.load(self._file(f'{col}.codes.npy'), mmap_mode='r')
+                spec['dictionary'] = np.array(spec['dictionary'], dtype=object)
+            else:
+                offsets = np.load(self._file(f'{col}.offsets.npy'), mmap_mode='r')
+                blob_file = self._file(f'{col}.blob')
+                if os.path.getsize(blob_file) > 0:
+                    blob = np.memmap(blob_file, dtype=np.uint8, mode='r')
+                else:
+                    blob = np.empty(0, dtype=np.uint8)
+                self._arrays[col] = (offsets, blob)
+
+    def _file(self, name):
+        return os.path.join(self.store_path, name)
+
+    def value(self, col, i):
+        if col not in self.schema:
+            return None
+        kind = self.schema[col]['kind']
+        arr = self._arrays[col]
+        if kind == 'float':
+            return float(arr[i])
+        if kind == 'int':
+            return int(arr[i])
+        if kind == 'category':
+            code = arr[i]
+            return None if code < 0 else self.schema[col]['dictionary'][code]
+
+        offsets, blob = arr
+        raw = blob[offsets[i]:offsets[i + 1]].tobytes().decode('utf-8')
+        return json.loads(raw) if kind == 'json' else raw
+
+
+class MetadataStore:
+    """Read-only, memory-mapped columnar product metadata; rows are built on demand.
+
+    Rows appended with append_metadata_rows live in extra segments and continue the row numbering.
+    """
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self._segments = [_Segment(store_path)]
+
+        segments_file = os.path.join(store_path, SEGMENTS_NAME)
+        if os.path.exists(segments_file):
+            with open(segments_file) as f:
+                for name in json.load(f):
+                    self._segments.append(_Segment(os.path.join(store_path, name)))
+
+        self.schema = self._segments[0].schema
+        # id of the index build this store belongs to, see index.save_faiss_index_and_metadata
+        self.build_id = self._segments[0].build_id
+        self._starts = np.cumsum([0] + [seg.n_rows for seg in self._segments])
+        self.n_rows = int(self._starts[-1])
+
+    def __len__(self):
+        return self.n_rows
+
+    @property
+    def columns(self):
+        return list(self.schema.keys())
+
+    def _locate(self, i):
+        seg = int(np.searchsorted(self._starts, i, side='right')) - 1
+        return self._segments[seg], i - int(self._starts[seg])
+
+    def value(self, col, i):
+        segment, j = self._locate(i)
+        return segment.value(col, j)
+
+    def __getitem__(self, i):
+        i = int(i)
+        if i < 0 or i >= self.n_rows:
+            raise IndexError(f"row {i} out of range for metadata store of size {self.n_rows}")
+        segment, j = self._locate(i)
+        return {col: segment.value(col, j) for col in self.schema}
+
+    def rows(self, ids):
+        return [self[i] for i in ids]
+
+    def differs(self, i, row):
+        # True when a field of row (a dict) would be stored differently from row i
+        for col, value in row.items():
+            kind = self.schema[col]['kind'] if col in self.schema else METADATA_SCHEMA.get(col, 'json')
+            old, new = self.value(col, i), stored_value(value, kind)
+            if isinstance(old, float) and isinstance(new, float) and np.isnan(old) and np.isnan(new):
+                continue
+            if old != new:
+                return True
+        return False
+
+    def column(self, col):
+        # decoded column for numeric / categorical fields, used for vectorized filtering
+        kind = self.schema[col]['kind']
+        if len(self._segments) == 1:
+            arr = self._segments[0]._arrays[col]
+            if kind in ('float', 'int'):
+                return arr
+            if kind == 'category':
+                return arr, self.schema[col]['dictionary']
+        else:
+            if kind in ('float', 'int'):
+                return np.concatenate([seg._arrays[col] for seg in self._segments])
+            if kind == 'category':
+                # remap the codes of every segment onto one shared dictionary
+                dictionary = []
+                lookup = {}
+                codes = []
+                for seg in self._segments:
+                    seg_dict = seg.schema[col]['dictionary']
+                    remap = np.empty(len(seg_dict) + 1, dtype=np.int32)
+                    remap[-1] = -1
+                    for k, v in enumerate(seg_dict):
+                        if v not in lookup:
+                            lookup[v] = len(dictionary)
+                            dictionary.append(v)
+                        remap[k] = lookup[v]
+                    codes.append(remap[seg._arrays[col]])
+                return np.concatenate(codes), np.array(dictionary, dtype=object)
+        return [self.value(col, i) for i in range(self.n_rows)]
+
+
+def _segment_rows(folder):
+    with open(os.path.join(folder, MANIFEST_NAME)) as f:
+        return json.load(f)['n_rows']
+
+
+def append_metadata_rows(store_path, data):
+    # rows are added as a new segment, numbered after the existing rows.
+    # Returns the row numbers of the new rows
+    segments_file = os.path.join(store_path, SEGMENTS_NAME)
+    segments = []
+    if os.path.exists(segments_file):
+        with open(segments_file) as f:
+            segments = json.load(f)
+    # row count from the manifests, the segments are not opened
+    n_rows = _segment_rows(store_path) + sum(_segment_rows(os.path.join(store_path, name)) for name in segments)
+
+    name = f'segment_{len(segments) + 1:06d}'
+    write_metadata_store(os.path.join(store_path, name), data)
+
+    segments.append(name)
+    with open(segments_file + '.tmp', 'w') as f:
+        json.dump(segments, f)
+    os.replace(segments_file + '.tmp', segments_file)
+
+    return np.arange(n_rows, n_rows + len(data), dtype=np.int64)
+
+
+def write_metadata_store_chunks(store_path, chunks):
+    # chunks: iterable of DataFrames written as one segment, so only one chunk is in
+    # memory at a time. Returns the store
+    writer = MetadataStoreWriter(store_path)
+    for chunk in chunks:
+        writer.append(chunk)
+    writer.close()
+    return MetadataStore(store_path)
+
+
+def set_build_id(store_path, build_id):
+    manifest_file = os.path.join(store_path, MANIFEST_NAME)
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    manifest['build_id'] = build_id
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def save_metadata(metadata_path, metadata, build_id=None):
+    # build_id is recorded in the columnar store only, pickles have no room for it
+    if isinstance(metadata, MetadataStore):
+        # built on disk already (streamed builds), swapped in as it is
+        if metadata_path.endswith('.pkl'):
+            metadata = metadata.rows(range(len(metadata)))
+        else:
+            set_build_id(metadata.store_path, build_id)
+            if os.path.abspath(metadata.store_path) != os.path.abspath(metadata_path):
+                _swap_in(metadata.store_path, metadata_path)
+            return
+    # legacy pickled list of dicts when the path ends with .pkl
+    if metadata_path.endswith('.pkl'):
+        if isinstance(metadata, pd.DataFrame):
+            metadata = metadata.to_dict(orient='records')
+        with open(metadata_path + '.tmp', 'wb') as f:
+            pickle.dump(metadata, f)
+        os.replace(metadata_path + '.tmp', metadata_path)
+    else:
+        write_metadata_store(metadata_path, metadata, build_id=build_id)
+
+
+def resolve_metadata_path(metadata_path):
+    # deployments of the pretrained index only have <metadata_path>.pkl: it is converted
+    # to the columnar store once, or loaded as the pickle when the folder is not writable
+    pkl_path = metadata_path + '.pkl'
+    if os.path.exists(metadata_path) or not os.path.exists(pkl_path):
+        return metadata_path
+    try:
+        print(f"Converting {pkl_path} to the columnar metadata store {metadata_path}...")
+        convert_pickle_metadata(pkl_path, metadata_path)
+    except OSError as e:
+        print(f"Could not convert {pkl_path} ({e}), loading the pickle instead")
+        return pkl_path
+    return metadata_path
+
+
+def load_metadata(metadata_path):
+    metadata_path = resolve_metadata_path(metadata_path)
+    if os.path.isdir(metadata_path):
+        return MetadataStore(metadata_path)
+    with open(metadata_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def convert_pickle_metadata(pkl_path, store_path):
+    # one-off migration of an existing faiss_metadata.pkl
+    with open(pkl_path, 'rb') as f:
+        metadata = pickle.load(f)
+    write_metadata_store(store_path, metadata)
@@ -0,0 +1,156 @@
+import json
+import time
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+# span durations in seconds, upper bounds of the prometheus histogram buckets
+SPAN_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    """One timed operation, nested under the span that was active when it started."""
+
+    __slots__ = ('name', 'attrs', 'parent', 'children', 'start', 'duration')
+
+    def __init__(self, name, attrs, parent):
+        self.name = name
+        self.attrs = attrs
+        self.parent = parent
+        self.children = []
+        self.start = time.time()
+        self.duration = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self):
+        return {'span': self.name, 'start': self.start, 'duration_ms': round(self.duration * 1000, 3),
+                **({'attrs': self.attrs} if self.attrs else {}),
+                **({'children': [c.to_dict() for c in self.children]} if self.children else {})}
+
+
+class Metrics:
+    """Counters and span duration histograms of the retrieval pipeline.
+
+    Read them in-process with snapshot() / recent_traces(), as prometheus text with
+    render_prometheus(), or as one json line per finished top-level span with enable_json_log().
+    """
+
+    def __init__(self, max_traces=100):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._spans = {}
+        self._traces = deque(maxlen=max_traces)
+        self._json_log = None
+
+    def incr(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def span(self, name, **attrs):
+        parent = _current_span.get()
+        span = Span(name, attrs, parent)
+        token = _current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span.attrs['error'] = type(e).__name__
+            raise
+        finally:
+            span.duration = time.perf_counter() - start
+            _current_span.reset(token)
+            self._finish(span)
+
+    def _finish(self, span):
+        with self._lock:
+            stats = self._spans.get(span.name)
+            if stats is None:
+                stats = self._spans[span.name] = {'count': 0, 'sum': 0.0, 'max': 0.0,
+                                                  'buckets': [0] * len(SPAN_BUCKETS)}
+            stats['count'] += 1
+            stats['sum'] += span.duration
+            stats['max'] = max(stats['max'], span.duration)
+            for i, bound in enumerate(SPAN_BUCKETS):
+                if span.duration <= bound:
+                    stats['buckets'][i] += 1
+                    break
+
+            if span.parent is not None:
+                span.parent.children.append(span)
+                return
+            self._traces.append(span)
+            log = self._json_log
+
+        if log is not None:
+            line = json.dumps(span.to_dict(), default=str)
+            with self._lock:
+                log.write(line + '\n')
+                log.flush()
+
+    def enable_json_log(self, path):
+        # one json line per finished top-level span (e.g. a whole retrieve) with its nested spans
+        with self._lock:
+            if self._json_log is not None:
+                self._json_log.close()
+            self._json_log = open(path, 'a') if path else None
+
+    def snapshot(self):
+        with self._lock:
+            counters = {}
+            for (name, labels), value in self._counters.items():
+                label_str = ','.join(f'{k}={v}' for k, v in labels)
+                counters[f'{name}{{{label_str}}}' if labels else name] = value
+            spans = {
+                name: {'count': s['count'], 'total_s': s['sum'], 'mean_ms': 1000 * s['sum'] / s['count'],
+                       'max_ms': 1000 * s['max']}
+                for name, s in self._spans.items()
+            }
+        return {'counters': counters, 'spans': spans}
+
+    def recent_traces(self):
+        with self._lock:
+            return [span.to_dict() for span in self._traces]
+
+    def render_prometheus(self, prefix='fashion_search'):
+        lines = []
+        with self._lock:
+            names = sorted({name for name, _ in self._counters})
+            for name in names:
+                lines.append(f'# TYPE {prefix}_{name} counter')
+                for (n, labels), value in sorted(self._counters.items()):
+                    if n == name:
+                        label_str = ','.join(f'{k}="{v}"' for k, v in labels)
+                        lines.append(f'{prefix}_{name}{{{label_str}}} {value}' if labels else f'{prefix}_{name} {value}')
+
+            metric = f'{prefix}_span_duration_seconds'
+            if self._spans:
+                lines.append(f'# TYPE {metric} histogram')
+            for name, s in sorted(self._spans.items()):
+                cumulative = 0
+                for bound, count in zip(SPAN_BUCKETS, s['buckets']):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{span="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{span="{name}",le="+Inf"}} {s["count"]}')
+                lines.append(f'{metric}_sum{{span="{name}"}} {s["sum"]}')
+                lines.append(f'{metric}_count{{span="{name}"}} {s["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._spans.clear()
+            self._traces.clear()
+
+
+# process-wide registry used by index.py, retriever.py and cache.py
+metrics = Metrics()
+span = metrics.span
+incr = metrics.incr
+
@@ -0,0 +1,197 @@
+import os
+import time
+import threading
+
+from sentence_transformers import SentenceTransformer
+
+from config import *
+from index import *
+from data_process import CategoryTagger
+from cache import CachedEncoder, embedding_cache
+from metadata_store import resolve_metadata_path
+from metrics import metrics, span, incr
+
+
+class Retriever:
+    """Keeps the text model, FAISS index and metadata loaded between queries."""
+
+    def __init__(self,
+                 index_path=index_path,
+                 metadata_path=metadata_path,
+                 text_model_path=text_model_path,
+                 openai_api_key=None,
+                 text_model=None,
+                 text_model_name=None,
+                 cache_db_path=cache_db_path,
+                 metrics_log_path=metrics_log_path):
+        # text_model_name keys the cached keyword embeddings, an injected model has to name itself
+        if text_model is not None and not text_model_name:
+            raise ValueError("text_model_name is required when a text_model is passed")
+        self.index_path = index_path
+        self.metadata_path = resolve_metadata_path(metadata_path)
+        self.openai_api_key = openai_api_key
+
+        if metrics_log_path:
+            metrics.enable_json_log(metrics_log_path)
+
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._signature = None
+        self.index = None
+        self.metadata = None
+        self.metadata_filter = None
+        self.full_vectors = None
+
+        self.rephrase_cache = LRUCache(max_size=rephrase_cache_size,
+                                       ttl=rephrase_cache_ttl,
+                                       db_path=cache_db_path,
+                                       namespace='rephrase')
+        self.verdict_cache = LRUCache(max_size=verdict_cache_size,
+                                      ttl=verdict_cache_ttl,
+                                      db_path=cache_db_path,
+                                      namespace='verdict')
+
+        print("Loading text embedding model...")
+        # keyword embeddings are cached, subcategory names are the most common keywords
+        self.text_model = CachedEncoder(text_model or SentenceTransformer(text_model_path),
+                                        embedding_cache(max_size=keyword_cache_size, db_path=cache_db_path),
+                                        model_name=text_model_name if text_model is not None else text_model_path)
+        self.text_model.preload(sub for subs in fashion_categories.values() for sub in subs)
+        self._category_tagger = None
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.load()
+
+    def _file_signature(self):
+        # inode + mtime + size of both paths, changes whenever the index is rebuilt
+        signature = []
+        paths = [self.index_path, self.metadata_path]
+        if os.path.exists(vectors_path(self.index_path)):
+            paths.append(vectors_path(self.index_path))
+        for path in paths:
+            stat = os.stat(path)
+            signature.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    def load(self, timeout=10):
+        # keep reading until the files are stable across the whole load and the index and
+        # metadata carry the same build id, so a rebuild that lands mid-read does not leave
+        # a mismatched index/metadata. The index and full-precision vectors are read
+        # before the metadata, which a rebuild swaps in first
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                signature = self._file_signature()
+                build_id = read_build_id(self.index_path)
+                # only quantized indexes have full-precision vectors on disk
+                index, metadata, full_vectors = load_faiss_index_and_metadata(self.index_path, self.metadata_path,
+                                                                              full_vectors=rerank_factor > 1)
+                if (self._file_signature() == signature and read_build_id(self.index_path) == build_id
+                        and getattr(metadata, 'build_id', None) == build_id):
+                    break
+            except FileNotFoundError:
+                # a folder was swapped out during the read
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{self.index_path} and {self.metadata_path} belong to different builds")
+            time.sleep(0.05)
+
+        set_search_params(index, nprobe=self.nprobe, ef_search=self.ef_search)
+        metadata_filter = MetadataFilter(metadata)
+
+        # swap in one step, searches already running keep the old snapshot
+        with self._lock:
+            self.index, self.metadata, self._signature = index, metadata, signature
+            self.metadata_filter = metadata_filter
+            self.full_vectors = full_vectors
+
+    def reload_if_changed(self):
+        try:
+            signature = self._file_signature()
+        except FileNotFoundError:
+            # files are being replaced, keep serving the current snapshot
+            return False
+
+        if signature == self._signature:
+            return False
+
+        # only one thread reloads, the others keep searching the old snapshot
+        if not self._reload_lock.acquire(blocking=False):
+            return False
+        try:
+            incr('index_reloads_total')
+            self.load()
+        except RuntimeError as e:
+            # e.g. a rebuild that died half way, keep the current snapshot until the files change again
+            print(f"Index reload skipped: {e}")
+            self._signature = signature
+            return False
+        finally:
+            self._reload_lock.release()
+        return True
+
+    def set_search_params(self, nprobe=None, ef_search=None):
+        # speed / recall trade-off of ivf (nprobe) and hnsw (ef_search) indexes,
+        # also applied to indexes loaded later
+        self.nprobe = nprobe or self.nprobe
+        self.ef_search = ef_search or self.ef_search
+        with self._lock:
+            set_search_params(self.index, nprobe=self.nprobe, ef_search=self.ef_search)
+
+    def snapshot(self):
+        with self._lock:
+            return self.index, self.metadata, self.metadata_filter, self.full_vectors
+
+    def search(self, query_text, openai_api_key=None, base_k=base_k, fusion=fusion, filters=None,
+               search_batcher=None, on_candidates=None, on_verdicts=None):
+        with span('retrieve', query=query_text, filters=filters):
+            self.reload_if_changed()
+            index, metadata, metadata_filter, full_vectors = self.snapshot()
+
+            openai_api_key = openai_api_key or self.openai_api_key
+            client = get_openai_client(openai_api_key,
+                                       base_url=openai_base_url,
+                                       timeout=verification_timeout)
+
+            return search_faiss_index(
+                index,
+                metadata,
+                query_text,
+                self.text_model,
+                openai_api_key,
+                base_k=base_k,
+                fusion=fusion,
+                client=client,
+                max_workers=verification_workers,
+                max_retries=verification_max_retries,
+                rephrase_cache=self.rephrase_cache,
+                verdict_cache=self.verdict_cache,
+                filters=filters,
+                metadata_filter=metadata_filter,
+                full_vectors=full_vectors,
+                rerank_factor=rerank_factor,
+                search_batcher=search_batcher,
+                on_candidates=on_candidates,
+                on_verdicts=on_verdicts,
+                verify_target=verification_target,
+                verify_budget_s=verification_budget_s,
+                verify_max_calls=verification_max_calls,
+                verify_batch_size=verification_batch_size,
+            )
+
+    @property
+    def category_tagger(self):
+        # subcategory embeddings are only computed the first time they are needed
+        if self._category_tagger is None:
+            self._category_tagger = CategoryTagger.from_model(fashion_categories, self.text_model)
+        return self._category_tagger
+
+    def infer_category(self, query_text, k=3):
+        # top k (category, subcategory, score) for a query, e.g. to pre-select a category filter
+        query_vec = self.text_model.encode([query_text])
+        return self.category_tagger.infer(query_vec, k=k)
+
+    def cache_stats(self):
+        return {'rephrase': self.rephrase_cache.stats(),
+                'verdict': self.verdict_cache.stats(),
+                'keyword_embedding': self.text_model.cache.stats()}
@@ -0,0 +1,231 @@
+# Standalone retrieval service: python server.py --port 8000
+#   POST /search   {"query": "...", "base_k": 10, "filters": {"category": ["Shoes"], "price": [20, 80]}}
+#                  the OpenAI key is the server's own (config.openai_api_key), never taken from a request
+#   GET  /metrics  prometheus text (see metrics.py)
+#   GET  /health
+import json
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from config import *
+from retriever import Retriever
+from filters import validate_filters
+from metrics import metrics, span, incr
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+
+class MicroBatcher:
+    """Collects the keyword searches of concurrent requests for up to max_wait_ms and runs
+    them as one text_model.encode call and one index.search call per index."""
+
+    def __init__(self, text_model, loop, max_batch_keywords=64, max_wait_ms=5):
+        self.text_model = text_model
+        self.loop = loop
+        self.max_batch_keywords = max_batch_keywords
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        # one batch at a time, the next one fills up while the current one is encoded
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def __call__(self, index, keywords, k, params):
+        # search_batcher interface of search_faiss_index, called from request threads
+        return asyncio.run_coroutine_threadsafe(self.submit(index, keywords, k, params), self.loop).result()
+
+    async def submit(self, index, keywords, k, params):
+        future = self.loop.create_future()
+        await self.queue.put((index, list(keywords), k, params, future))
+        return await future
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            n_keywords = len(batch[0][1])
+            deadline = self.loop.time() + self.max_wait
+            while n_keywords < self.max_batch_keywords:
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                n_keywords += len(item[1])
+
+            try:
+                results = await self.loop.run_in_executor(self.executor, self.run_batch, batch)
+            except Exception as e:
+                for item in batch:
+                    if not item[-1].done():
+                        item[-1].set_exception(e)
+                continue
+            for item, result in zip(batch, results):
+                if not item[-1].done():
+                    item[-1].set_result(result)
+
+    def run_batch(self, batch):
+        keywords = [kw for _, kws, _, _, _ in batch for kw in kws]
+        starts = np.cumsum([0] + [len(kws) for _, kws, _, _, _ in batch])
+        incr('server_batches_total')
+        incr('server_batched_requests_total', len(batch))
+
+        with span('batch', n_requests=len(batch), n_keywords=len(keywords)):
+            with span('batch_encode', n_keywords=len(keywords)):
+                query_vecs = np.ascontiguousarray(
+                    self.text_model.encode(keywords, batch_size=len(keywords)), dtype="float32"
+                ).reshape(len(keywords), -1)
+
+            results = [None] * len(batch)
+            with span('batch_search'):
+                # unfiltered requests on the same index share one search with the largest k
+                groups = {}
+                for i, (index, _, _, params, _) in enumerate(batch):
+                    if params is None:
+                        groups.setdefault(id(index), []).append(i)
+                    else:
+                        # each filter has its own id selector, searched on its own
+                        vecs = query_vecs[starts[i]:starts[i + 1]]
+                        D, I = index.search(vecs, batch[i][2], params=params)
+                        results[i] = (vecs, D, I)
+
+                for members in groups.values():
+                    index = batch[members[0]][0]
+                    k = max(batch[i][2] for i in members)
+                    rows = np.concatenate([np.arange(starts[i], starts[i + 1]) for i in members])
+                    D, I = index.search(query_vecs[rows], k)
+                    offset = 0
+                    for i in members:
+                        n, k_i = starts[i + 1] - starts[i], batch[i][2]
+                        results[i] = (query_vecs[starts[i]:starts[i + 1]],
+                                      D[offset:offset + n, :k_i], I[offset:offset + n, :k_i])
+                        offset += n
+        return results
+
+
+class RetrievalServer:
+    """asyncio HTTP/1.1 server around a Retriever, searches share encodes through a MicroBatcher."""
+
+    def __init__(self, retriever, request_workers=32, max_batch_keywords=64, max_wait_ms=5):
+        self.retriever = retriever
+        self.request_workers = request_workers
+        self.max_batch_keywords = max_batch_keywords
+        self.max_wait_ms = max_wait_ms
+        self.batcher = None
+        self.executor = None
+
+    async def serve(self, host='127.0.0.1', port=8000, ready=None):
+        loop = asyncio.get_running_loop()
+        # rephrasing and verification block on the OpenAI API, they run in worker threads
+        self.executor = ThreadPoolExecutor(max_workers=self.request_workers)
+        self.batcher = MicroBatcher(self.retriever.text_model, loop,
+                                    max_batch_keywords=self.max_batch_keywords,
+                                    max_wait_ms=self.max_wait_ms)
+        batcher_task = asyncio.create_task(self.batcher.run())
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Serving on http://{host}:{port}")
+        if ready is not None:
+            ready.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher_task.cancel()
+            self.executor.shutdown(wait=False)
+
+    async def handle(self, reader, writer):
+        # keep-alive connection, one request after the other
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, content_type, payload = await self.route(method, path.split('?')[0], body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write(
+                    f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        if method == 'GET' and path == '/health':
+            return 200, 'application/json', b'{"status": "ok"}'
+        if method == 'GET' and path == '/metrics':
+            return 200, 'text/plain; version=0.0.4', metrics.render_prometheus().encode('utf-8')
+        if method == 'POST' and path == '/search':
+            try:
+                request = json.loads(body or b'{}')
+                query = request['query']
+            except (ValueError, KeyError, TypeError):
+                return 400, 'application/json', b'{"error": "expected a json body with a query"}'
+            try:
+                validate_filters(request.get('filters'))
+                request['base_k'] = int(request.get('base_k', base_k))
+                if request['base_k'] < 1:
+                    raise ValueError("base_k must be a positive integer")
+            except (ValueError, TypeError) as e:
+                return 400, 'application/json', json.dumps({'error': str(e)}).encode('utf-8')
+            try:
+                payload = await asyncio.get_running_loop().run_in_executor(self.executor, self.search, request)
+            except Exception as e:
+                incr('server_errors_total')
+                return 500, 'application/json', json.dumps({'error': f"{type(e).__name__}: {e}"}).encode('utf-8')
+            return 200, 'application/json', payload
+        return 404, 'application/json', b'{"error": "not found"}'
+
+    def search(self, request):
+        start = time.perf_counter()
+        results = self.retriever.search(request['query'],
+                                        base_k=request['base_k'],
+                                        filters=request.get('filters'),
+                                        search_batcher=self.batcher)
+        took_ms = (time.perf_counter() - start) * 1000
+        records = results.to_json(orient='records') if len(results) else '[]'
+        return f'{{"took_ms": {took_ms:.1f}, "n_results": {len(results)}, "results": {records}}}'.encode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default=server_host)
+    parser.add_argument('--port', type=int, default=server_port)
+    parser.add_argument('--max-wait-ms', type=float, default=server_batch_wait_ms)
+    parser.add_argument('--max-batch-keywords', type=int, default=server_max_batch_keywords)
+    parser.add_argument('--request-workers', type=int, default=server_request_workers)
+    args = parser.parse_args()
+
+    retriever = Retriever(index_path=index_path,
+                          metadata_path=metadata_path,
+                          text_model_path=text_model_path,
+                          openai_api_key=openai_api_key)
+    server = RetrievalServer(retriever,
+                             request_workers=args.request_workers,
+                             max_batch_keywords=args.max_batch_keywords,
+                             max_wait_ms=args.max_wait_ms)
+    asyncio.run(server.serve(args.host, args.port))
+
+
+if __name__ == '__main__':
+    main()
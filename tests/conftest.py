@@ -0,0 +1,123 @@
+import io
+import os
+import sys
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+# the modules live at the top level of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class OpenAIStub:
+    """Local stand-in for the OpenAI chat completions and responses endpoints.
+
+    chat_reply / responses_reply map the request json to the text the model answers.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.chat_reply = lambda body: "swimwear|||sandals"
+        self.responses_reply = lambda body: "no relevant images"
+        self.server = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def reply(self, path, body):
+        self.requests.append((path, body))
+        if path.endswith('/chat/completions'):
+            return {'id': 'chatcmpl-stub', 'object': 'chat.completion', 'created': 0, 'model': body['model'],
+                    'choices': [{'index': 0, 'finish_reason': 'stop',
+                                 'message': {'role': 'assistant', 'content': self.chat_reply(body)}}]}
+        if path.endswith('/responses'):
+            return {'id': 'resp-stub', 'object': 'response', 'created_at': 0, 'model': body['model'],
+                    'status': 'completed', 'parallel_tool_calls': False, 'tool_choice': 'auto', 'tools': [],
+                    'output': [{'type': 'message', 'id': 'msg-stub', 'role': 'assistant', 'status': 'completed',
+                                'content': [{'type': 'output_text', 'text': self.responses_reply(body),
+                                             'annotations': []}]}]}
+        return None
+
+
+@pytest.fixture
+def openai_stub():
+    stub = OpenAIStub()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            payload = stub.reply(self.path, body)
+            data = json.dumps(payload if payload is not None else {'error': 'not found'}).encode('utf-8')
+            self.send_response(200 if payload is not None else 404)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    stub.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=stub.server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    yield stub
+    stub.server.shutdown()
+    stub.server.server_close()
+
+
+class StaticServer:
+    """Local HTTP server answering GET with the (status, body, delay) registered for a path."""
+
+    def __init__(self):
+        self.routes = {}
+        self.hits = []
+        self.server = None
+
+    def url(self, path):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}{path}"
+
+    def add(self, path, body, status=200, delay=0.0, content_type='image/jpeg'):
+        self.routes[path] = (status, body, delay, content_type)
+        return self.url(path)
+
+
+@pytest.fixture
+def static_server():
+    server = StaticServer()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            server.hits.append(self.path)
+            status, body, delay, content_type = server.routes.get(self.path, (404, b'not found', 0.0, 'text/plain'))
+            time.sleep(delay)
+            try:
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def log_message(self, *args):
+            pass
+
+    server.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    yield server
+    server.server.shutdown()
+    server.server.server_close()
+
+
+def jpeg_bytes(color, size=(48, 32)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, format='JPEG', quality=95)
+    return buffer.getvalue()
@@ -0,0 +1,46 @@
+import os
+
+import numpy as np
+
+from conftest import jpeg_bytes
+from embedding import load_image
+from image_cache import ImageCache
+
+
+def test_cached_image_matches_uncached_download(static_server, tmp_path):
+    url = static_server.add('/img/large.jpg', jpeg_bytes((180, 90, 30), size=(640, 480)))
+    cache = ImageCache(str(tmp_path / 'images'))
+
+    uncached = load_image(url)
+    first = cache.get_clip_image(url)
+    second = cache.get_clip_image(url)
+    assert first.size == (640, 480)
+    assert np.array_equal(np.asarray(first), np.asarray(uncached))
+    assert np.array_equal(np.asarray(second), np.asarray(uncached))
+    assert static_server.hits.count('/img/large.jpg') == 2
+    assert cache.stats()['hits'] == 1
+
+
+def test_eviction_is_incremental(static_server, tmp_path, monkeypatch):
+    urls = [static_server.add(f'/img/{i}.jpg', jpeg_bytes((i * 10, 0, 0))) for i in range(20)]
+    cache = ImageCache(str(tmp_path / 'images'))
+    cache.get_path(urls[0])
+    per_url = cache.stats()['size_bytes']
+    cache.max_bytes = per_url * 5
+
+    walks = []
+    real_walk = os.walk
+    monkeypatch.setattr(os, 'walk', lambda *args, **kwargs: walks.append(args) or real_walk(*args, **kwargs))
+    for url in urls[1:]:
+        cache.get_path(url)
+    assert walks == []
+
+    on_disk = sum(os.path.getsize(os.path.join(root, name))
+                  for root, _, files in real_walk(cache.cache_dir) for name in files)
+    assert cache.stats()['size_bytes'] == on_disk <= cache.max_bytes
+    # the most recent url is kept, the oldest ones are gone
+    assert os.path.exists(cache._path(urls[-1], 'clip'))
+    assert not os.path.exists(cache._path(urls[0], 'clip'))
+
+    # a restarted cache picks the sizes up from disk
+    assert ImageCache(cache.cache_dir).stats()['size_bytes'] == on_disk
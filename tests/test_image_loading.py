@@ -0,0 +1,77 @@
+import time
+
+import numpy as np
+
+from conftest import jpeg_bytes
+from embedding import ImageLoadReport, get_clip_image_matrix, get_http_session, iter_image_batches, load_image
+from benchmarks.synthetic import FakeEncoder
+
+COLORS = [(200, 30, 40), (30, 60, 200), (40, 160, 60), (20, 20, 20)]
+
+
+def catalog_urls(static_server):
+    # good images, a 404, a slow url past the timeout, an undecodable body and a missing url
+    urls = [static_server.add(f'/img/{i}.jpg', jpeg_bytes(COLORS[i % len(COLORS)])) for i in range(8)]
+    urls[2] = static_server.url('/img/deleted.jpg')
+    urls[5] = static_server.add('/img/slow.jpg', jpeg_bytes(COLORS[0]), delay=1.5)
+    urls[6] = static_server.add('/img/broken.jpg', b'not a jpeg')
+    urls.append(None)
+    return urls
+
+
+def test_batches_keep_input_order_and_report_failures(static_server):
+    urls = catalog_urls(static_server)
+    report = ImageLoadReport()
+    batches = list(iter_image_batches(urls, batch_size=3, max_workers=4, prefetch_batches=1, timeout=0.3,
+                                      report=report, session=get_http_session(pool_size=4, retries=0)))
+
+    positions = [pos for batch_positions, _ in batches for pos in batch_positions]
+    assert positions == [0, 1, 3, 4, 7]
+    assert [len(images) for _, images in batches] == [2, 2, 1]
+    for batch_positions, images in batches:
+        for pos, image in zip(batch_positions, images):
+            assert image.size == (48, 32)
+            assert np.allclose(np.asarray(image).reshape(-1, 3).mean(axis=0), COLORS[pos % len(COLORS)], atol=3)
+
+    failures = {f['position']: f for f in report.failures}
+    assert sorted(failures) == [2, 5, 6, 8]
+    assert 'HTTPError' in failures[2]['error']
+    assert 'Timeout' in failures[5]['error']
+    assert failures[6]['stage'] == 'load'
+    assert failures[8]['stage'] == 'missing'
+    assert report.summary() == {'total': 9, 'ok': 0, 'failed': 4, 'by_stage': {'load': 3, 'missing': 1}}
+
+
+def test_downloads_overlap_with_encoding(static_server):
+    # 12 images that each take 0.2s to serve, downloaded 6 at a time ahead of the encoder
+    urls = [static_server.add(f'/img/{i}.jpg', jpeg_bytes(COLORS[0]), delay=0.2) for i in range(12)]
+    start = time.perf_counter()
+    for _ in iter_image_batches(urls, batch_size=6, max_workers=6, prefetch_batches=2, timeout=5):
+        time.sleep(0.2)  # encoding
+    # sequential downloads alone would take 2.4s
+    assert time.perf_counter() - start < 1.5
+
+
+def test_consumer_can_stop_early(static_server):
+    urls = [static_server.add(f'/img/{i}.jpg', jpeg_bytes(COLORS[1]), delay=0.05) for i in range(40)]
+    batches = iter_image_batches(urls, batch_size=4, max_workers=2, prefetch_batches=1, timeout=5)
+    next(batches)
+    start = time.perf_counter()
+    batches.close()
+    # the producer stops after its current batch instead of downloading the whole list
+    assert time.perf_counter() - start < 1.0
+    assert len(static_server.hits) < 20
+
+
+def test_clip_image_matrix_rows_follow_the_mask(static_server):
+    urls = catalog_urls(static_server)
+    report = ImageLoadReport()
+    encoder = FakeEncoder(dim=8)
+    matrix, valid = get_clip_image_matrix(urls, encoder, batch_size=3, report=report, max_workers=4,
+                                          timeout=0.3, progress=False)
+    assert valid.tolist() == [True, True, False, True, True, False, False, True, False]
+    assert matrix.shape == (5, 8) and matrix.dtype == np.float32
+    expected = [encoder.encode(load_image(urls[i])) for i in np.flatnonzero(valid)]
+    np.testing.assert_allclose(matrix, np.vstack(expected), rtol=1e-5)
+    assert report.n_ok == 5 and len(report.failures) == 4
+
@@ -0,0 +1,185 @@
+import os
+
+import faiss
+import numpy as np
+import pandas as pd
+import pytest
+
+import main
+from data_process import prepare_data, prepare_data_stream
+from metadata_store import MetadataStore, load_metadata
+from benchmarks.synthetic import FakeEncoder, generate_catalog
+
+
+@pytest.fixture
+def catalog(tmp_path, monkeypatch):
+    # synthetic catalog with local images, fake CLIP models and every output in tmp_path
+    data_path = str(tmp_path / 'catalog.jsonl')
+    generate_catalog(data_path, str(tmp_path / 'images'), n_products=120, n_images=16, duplicate_rate=0.1)
+    monkeypatch.setattr(main, 'SentenceTransformer', lambda path: FakeEncoder(dim=32))
+    monkeypatch.setattr(main, 'data_path', data_path)
+    monkeypatch.setattr(main, 'image_cache_dir', None)
+    monkeypatch.setattr(main, 'embedding_workers', 1)
+    monkeypatch.setattr(main, 'dedup_threshold', None)
+    monkeypatch.setattr(main, 'index_type', 'flat')
+    return tmp_path
+
+
+def use_index(monkeypatch, folder):
+    os.makedirs(folder, exist_ok=True)
+    monkeypatch.setattr(main, 'index_path', os.path.join(folder, 'faiss_index.index'))
+    monkeypatch.setattr(main, 'metadata_path', os.path.join(folder, 'faiss_metadata'))
+
+
+def read_index(folder):
+    index = faiss.read_index(os.path.join(folder, 'faiss_index.index'))
+    metadata = load_metadata(os.path.join(folder, 'faiss_metadata'))
+    return index.reconstruct_n(0, index.ntotal), pd.DataFrame(metadata.rows(range(len(metadata))))
+
+
+def test_stream_keeps_the_first_title_across_chunks(catalog):
+    data = prepare_data(main.data_path, cols_to_drop=main.cols_to_drop)
+    streamed = pd.concat(prepare_data_stream(main.data_path, cols_to_drop=main.cols_to_drop, chunksize=17),
+                         ignore_index=True)
+    assert streamed['parent_asin'].tolist() == data['parent_asin'].tolist()
+    assert streamed['title'].is_unique
+
+
+def test_streamed_build_matches_the_in_memory_build(catalog, monkeypatch):
+    use_index(monkeypatch, str(catalog / 'memory'))
+    main.index_creation()
+    use_index(monkeypatch, str(catalog / 'stream'))
+    main.index_creation(stream=True, chunksize=25)
+
+    vectors, metadata = read_index(str(catalog / 'memory'))
+    streamed_vectors, streamed_metadata = read_index(str(catalog / 'stream'))
+    np.testing.assert_allclose(streamed_vectors, vectors, atol=1e-6)
+    pd.testing.assert_frame_equal(streamed_metadata, metadata)
+    # only the index, its build id and the metadata store are left behind
+    assert sorted(os.listdir(catalog / 'stream')) == ['faiss_index.index', 'faiss_index.index.build_id', 'faiss_metadata']
+
+
+def test_streamed_chunks_go_to_disk(catalog, monkeypatch):
+    # the assembled build is a memory-mapped matrix and an on-disk metadata store
+    use_index(monkeypatch, str(catalog / 'stream'))
+    encoder = FakeEncoder(dim=32)
+    tagger = main.CategoryTagger.from_model(main.fashion_categories, encoder)
+    metadata, embeddings = main._embed_catalog(encoder, encoder, tagger, None, None, None,
+                                               True, 25, None, None)
+    assert isinstance(metadata, MetadataStore)
+    assert isinstance(embeddings, np.memmap)
+    assert len(metadata) == len(embeddings) > 25
+    # the temporary shards are removed once they are assembled
+    assert not [name for name in os.listdir(catalog / 'stream') if name.startswith('shards_')]
+
+
+def live_rows(folder):
+    index = faiss.read_index(os.path.join(folder, 'faiss_index.index'))
+    metadata = load_metadata(os.path.join(folder, 'faiss_metadata'))
+    ids = main.live_ids(index)
+    return {metadata.value('parent_asin', int(i)): (metadata[int(i)], index.reconstruct(int(i))) for i in ids}
+
+
+def write_delta(path, lines):
+    pd.DataFrame(lines).to_json(path, orient='records', lines=True)
+    return str(path)
+
+
+def no_models(path):
+    raise AssertionError("the delta should not need the embedding models")
+
+
+def test_delete_only_delta(catalog, monkeypatch):
+    use_index(monkeypatch, str(catalog / 'index'))
+    main.index_creation()
+    before = live_rows(str(catalog / 'index'))
+    asin = sorted(before)[0]
+
+    monkeypatch.setattr(main, 'SentenceTransformer', no_models)
+    main.update_index(write_delta(catalog / 'delta.jsonl', [{'parent_asin': asin, 'deleted': True}]),
+                      background_compaction=False)
+    after = live_rows(str(catalog / 'index'))
+    assert sorted(after) == sorted(before)[1:]
+
+
+def test_price_only_delta_keeps_the_vector(catalog, monkeypatch):
+    use_index(monkeypatch, str(catalog / 'index'))
+    main.index_creation()
+    before = live_rows(str(catalog / 'index'))
+    products = pd.read_json(main.data_path, lines=True)
+    product = products[products['parent_asin'] == sorted(before)[0]].iloc[0].to_dict()
+    unchanged = products[products['parent_asin'] == sorted(before)[1]].iloc[0].to_dict()
+
+    monkeypatch.setattr(main, 'SentenceTransformer', no_models)
+    main.update_index(write_delta(catalog / 'delta.jsonl', [{**product, 'price': product['price'] + 5,
+                                                             'rating_number': 999}, unchanged]),
+                      background_compaction=False)
+    after = live_rows(str(catalog / 'index'))
+    assert sorted(after) == sorted(before)
+    row, vector = after[product['parent_asin']]
+    old_row, old_vector = before[product['parent_asin']]
+    assert row['price'] == old_row['price'] + 5
+    assert row['rating_number'] == 999
+    assert (row['category'], row['subcategory']) == (old_row['category'], old_row['subcategory'])
+    np.testing.assert_array_equal(vector, old_vector)
+    # the product without changes keeps its row
+    assert after[unchanged['parent_asin']][0] == before[unchanged['parent_asin']][0]
+    assert len(load_metadata(main.metadata_path)) == len(before) + 1
+
+
+def test_product_whose_new_image_fails_stays_listed(catalog, monkeypatch):
+    use_index(monkeypatch, str(catalog / 'index'))
+    main.index_creation()
+    before = live_rows(str(catalog / 'index'))
+    products = pd.read_json(main.data_path, lines=True).set_index('parent_asin', drop=False)
+    broken, changed = sorted(before)[:2]
+    missing = [{'thumb': None, 'large': str(catalog / 'images' / 'missing.jpg'), 'variant': 'MAIN', 'hi_res': None}]
+
+    main.update_index(write_delta(catalog / 'delta.jsonl', [
+        {**products.loc[broken].to_dict(), 'title': 'renamed', 'images': missing},
+        {**products.loc[changed].to_dict(), 'title': 'renamed too'},
+    ]), background_compaction=False)
+    after = live_rows(str(catalog / 'index'))
+    assert sorted(after) == sorted(before)
+    # the old row and vector are kept until the image loads
+    assert after[broken][0] == before[broken][0]
+    np.testing.assert_array_equal(after[broken][1], before[broken][1])
+    assert after[changed][0]['title'] == 'renamed too'
+
+
+def test_deltas_follow_collapsed_variants(catalog, monkeypatch):
+    generate_catalog(main.data_path, str(catalog / 'images'), n_products=200, n_images=16, reupload_rate=0.2)
+    monkeypatch.setattr(main, 'dedup_threshold', 0.95)
+    use_index(monkeypatch, str(catalog / 'index'))
+    main.index_creation()
+    before = live_rows(str(catalog / 'index'))
+    rep_a, rep_b, rep_c = sorted(asin for asin, (row, _) in before.items() if len(row['variants']) == 2)[:3]
+    (va, va_kept), (vb, vb_kept), (vc, vc_kept) = ([v['parent_asin'] for v in before[rep][0]['variants']]
+                                                   for rep in (rep_a, rep_b, rep_c))
+    products = pd.read_json(main.data_path, lines=True).set_index('parent_asin', drop=False)
+
+    # a deleted variant, an updated variant and a deleted representative
+    main.update_index(write_delta(catalog / 'delta.jsonl', [
+        {'parent_asin': va, 'deleted': True},
+        {**products.loc[vb].to_dict(), 'price': products.loc[vb, 'price'] + 1},
+        {'parent_asin': rep_c, 'deleted': True},
+    ]), background_compaction=False)
+    after = live_rows(str(catalog / 'index'))
+    assert sorted(after) == sorted(set(before) - {rep_c} | {vb, vc})
+
+    assert [v['parent_asin'] for v in after[rep_a][0]['variants']] == [va_kept]
+    np.testing.assert_array_equal(after[rep_a][1], before[rep_a][1])
+    assert [v['parent_asin'] for v in after[rep_b][0]['variants']] == [vb_kept]
+    assert after[vb][0]['price'] == products.loc[vb, 'price'] + 1
+    assert after[vb][0]['variants'] == []
+    # the most reviewed variant takes over the representative's vector
+    assert [v['parent_asin'] for v in after[vc][0]['variants']] == [vc_kept]
+    assert after[vc][0]['title'] == products.loc[vc, 'title']
+    np.testing.assert_array_equal(after[vc][1], before[rep_c][1])
+
+    # its own delta line embeds it again, the variants stay
+    main.update_index(write_delta(catalog / 'delta.jsonl', [products.loc[vc].to_dict()]),
+                      background_compaction=False)
+    row, vector = live_rows(str(catalog / 'index'))[vc]
+    assert row['content_hash'] and [v['parent_asin'] for v in row['variants']] == [vc_kept]
+    assert not np.array_equal(vector, before[rep_c][1])
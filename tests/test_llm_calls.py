@@ -0,0 +1,107 @@
+import ast
+import time
+
+import faiss
+import numpy as np
+
+import index as index_module
+from index import (get_openai_client, rephrase_query_for_embedding, verify_candidates,
+                   build_faiss_index, search_faiss_index)
+from cache import LRUCache
+from benchmarks.synthetic import FakeEncoder
+
+
+def relevant_if_red(body):
+    # the ids are listed in the prompt in the same order as the images
+    content = body['input'][0]['content']
+    text = content[0]['text']
+    ids = ast.literal_eval(text.split('provided list: ')[1].splitlines()[0].strip())
+    urls = [item['image_url'] for item in content[1:]]
+    relevant = [i for i, url in zip(ids, urls) if 'red' in url]
+    return '|||'.join(relevant) if relevant else 'no relevant images'
+
+
+def test_rephrase_goes_through_the_configured_client(openai_stub):
+    client = get_openai_client('test-key', base_url=openai_stub.url)
+    cache = LRUCache(10)
+
+    keywords = rephrase_query_for_embedding("beach holiday", cache=cache, client=client)
+    assert keywords == ['swimwear', 'sandals']
+    path, body = openai_stub.requests[0]
+    assert path == '/v1/chat/completions'
+    assert body['messages'][-1]['content'] == 'Query: beach holiday'
+
+    # the second call is answered by the cache
+    assert rephrase_query_for_embedding("Beach  holiday", cache=cache, client=client) == keywords
+    assert len(openai_stub.requests) == 1
+
+
+def test_rephrase_not_relevant(openai_stub):
+    openai_stub.chat_reply = lambda body: "not relevant to fashion products"
+    client = get_openai_client('test-key', base_url=openai_stub.url)
+    assert rephrase_query_for_embedding("weather", client=client) == "not relevant to fashion products"
+
+
+def test_verify_candidates_against_the_stub(openai_stub):
+    openai_stub.responses_reply = relevant_if_red
+    client = get_openai_client('test-key', base_url=openai_stub.url)
+    check_dict = {f'A{i}': f"http://img/{'red' if i % 3 == 0 else 'blue'}/{i}.jpg" for i in range(12)}
+
+    relevant, unverified = verify_candidates(check_dict, "red dress", 'test-key', client=client, batch_size=5)
+    assert relevant == ['A0', 'A3', 'A6', 'A9']
+    assert unverified == []
+    assert [path for path, _ in openai_stub.requests] == ['/v1/responses'] * 3
+
+
+def test_search_uses_one_client_for_rephrase_and_verification(openai_stub):
+    openai_stub.chat_reply = lambda body: "red dress|||blue dress"
+    openai_stub.responses_reply = relevant_if_red
+    encoder = FakeEncoder(dim=32)
+    titles = ['red dress', 'blue dress', 'green shirt', 'red dress long', 'blue jeans']
+    metadata = [{'parent_asin': f'A{i}', 'title': t, 'main_image': f"http://img/{t.replace(' ', '_')}.jpg"}
+                for i, t in enumerate(titles)]
+    embeddings = np.ascontiguousarray(encoder.encode(titles), dtype='float32')
+    faiss.normalize_L2(embeddings)
+    index = build_faiss_index(embeddings)
+
+    client = get_openai_client('test-key', base_url=openai_stub.url)
+    results = search_faiss_index(index, metadata, "something for a party", encoder, 'test-key',
+                                 base_k=3, client=client)
+    assert sorted(results['parent_asin']) == ['A0', 'A3']
+    assert results['verified'].all()
+    paths = [path for path, _ in openai_stub.requests]
+    assert paths[0] == '/v1/chat/completions'
+    assert set(paths[1:]) == {'/v1/responses'}
+
+
+def test_default_client_uses_the_module_key(openai_stub, monkeypatch):
+    # without a client the rephrase call still goes through get_openai_client
+    calls = []
+
+    def stub_client(openai_api_key, base_url=None, timeout=30.0):
+        calls.append(openai_api_key)
+        return get_openai_client('test-key', base_url=openai_stub.url)
+    monkeypatch.setattr(index_module, 'get_openai_client', stub_client)
+    monkeypatch.setattr(index_module.openai, 'api_key', 'module-key')
+
+    assert rephrase_query_for_embedding("beach") == ['swimwear', 'sandals']
+    assert calls == ['module-key']
+
+
+def test_no_batches_are_sent_after_the_budget(openai_stub):
+    openai_stub.responses_reply = relevant_if_red
+    client = get_openai_client('test-key', base_url=openai_stub.url)
+    check_dict = {f'A{i}': f"http://img/red/{i}.jpg" for i in range(12)}
+
+    relevant, unverified = verify_candidates(check_dict, "red dress", 'test-key', client=client, budget_s=0)
+    assert (relevant, unverified) == ([], list(check_dict))
+
+    # the cached verdicts are reported first, a slow callback uses up the budget
+    cache = LRUCache()
+    verify_candidates({'A0': check_dict['A0']}, "red dress", 'test-key', client=client, verdict_cache=cache)
+    n_requests = len(openai_stub.requests)
+    relevant, unverified = verify_candidates(check_dict, "red dress", 'test-key', client=client,
+                                             verdict_cache=cache, budget_s=0.1,
+                                             on_verdicts=lambda verdicts: time.sleep(0.2))
+    assert (relevant, unverified) == (['A0'], list(check_dict)[1:])
+    assert len(openai_stub.requests) == n_requests == 1
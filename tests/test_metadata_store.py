@@ -0,0 +1,76 @@
+import os
+import time
+import pickle
+
+import pandas as pd
+import pytest
+
+import metadata_store
+from metadata_store import (MetadataStore, load_metadata, resolve_metadata_path, write_metadata_store,
+                            write_metadata_store_chunks)
+
+ROWS = [
+    {'parent_asin': 'A1', 'title': 'red dress', 'store': 's1', 'features': ['silk'], 'price': 20.0},
+    {'parent_asin': 'A2', 'title': 'blue jeans', 'store': 's2', 'features': [], 'price': None},
+]
+
+
+def write_pickle(path):
+    with open(path, 'wb') as f:
+        pickle.dump(ROWS, f)
+
+
+def test_pickle_next_to_the_default_path_is_converted(tmp_path):
+    metadata_path = str(tmp_path / 'faiss_metadata')
+    write_pickle(metadata_path + '.pkl')
+
+    metadata = load_metadata(metadata_path)
+    assert isinstance(metadata, MetadataStore)
+    assert os.path.isdir(metadata_path)
+    assert metadata[0]['title'] == 'red dress'
+    assert metadata[1]['features'] == []
+    # the second load uses the store that is now on disk
+    assert resolve_metadata_path(metadata_path) == metadata_path
+
+
+def test_pickle_is_loaded_when_it_cannot_be_converted(tmp_path, monkeypatch):
+    metadata_path = str(tmp_path / 'faiss_metadata')
+    write_pickle(metadata_path + '.pkl')
+
+    def read_only(pkl_path, store_path):
+        raise PermissionError("read-only file system")
+    monkeypatch.setattr(metadata_store, 'convert_pickle_metadata', read_only)
+
+    assert resolve_metadata_path(metadata_path) == metadata_path + '.pkl'
+    assert load_metadata(metadata_path) == ROWS
+
+
+def test_missing_metadata_is_left_to_the_loader(tmp_path):
+    metadata_path = str(tmp_path / 'faiss_metadata')
+    assert resolve_metadata_path(metadata_path) == metadata_path
+    with pytest.raises(FileNotFoundError):
+        load_metadata(metadata_path)
+
+
+def test_chunks_are_written_as_one_segment(tmp_path):
+    chunks = [pd.DataFrame([{**row, 'parent_asin': f'{row["parent_asin"]}-{i}', 'store': f's{i % 3}'} for row in ROWS])
+              for i in range(300)]
+    # a column that only later chunks have
+    chunks[5]['variants'] = [[{'parent_asin': 'V1'}], []]
+
+    start = time.perf_counter()
+    store = write_metadata_store_chunks(str(tmp_path / 'streamed'), iter(chunks))
+    assert time.perf_counter() - start < 5
+    assert not os.path.exists(tmp_path / 'streamed' / metadata_store.SEGMENTS_NAME)
+
+    write_metadata_store(str(tmp_path / 'whole'), pd.concat(chunks, ignore_index=True))
+    whole = MetadataStore(str(tmp_path / 'whole'))
+    assert len(store) == len(whole) == 600
+    # pandas fills the missing variants with NaN, the writer with None
+    pd.testing.assert_frame_equal(pd.DataFrame(store.rows(range(600))).drop(columns='variants'),
+                                  pd.DataFrame(whole.rows(range(600))).drop(columns='variants'))
+    assert [row['variants'] for row in store.rows(range(9, 13))] == [None, [{'parent_asin': 'V1'}], [], None]
+
+    # appended rows are numbered from the manifests
+    assert list(metadata_store.append_metadata_rows(store.store_path, pd.DataFrame(ROWS))) == [600, 601]
+    assert MetadataStore(store.store_path)[601]['parent_asin'] == 'A2'
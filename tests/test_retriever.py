@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cache import CachedEncoder, LRUCache
+import index
+import metadata_store
+from index import load_full_vectors, read_build_id, save_faiss_index_and_metadata, vectors_path
+from metadata_store import load_metadata
+from retriever import Retriever
+from benchmarks.synthetic import FakeEncoder
+
+
+def test_injected_text_model_needs_a_name():
+    with pytest.raises(ValueError, match='text_model_name'):
+        Retriever(text_model=FakeEncoder(dim=8), cache_db_path=None, metrics_log_path=None)
+
+
+def test_models_do_not_share_cached_embeddings():
+    cache = LRUCache()
+    small = CachedEncoder(FakeEncoder(dim=8), cache, model_name='fake-8')
+    large = CachedEncoder(FakeEncoder(dim=16), cache, model_name='fake-16')
+    assert small.encode('red dress').shape == (8,)
+    assert large.encode('red dress').shape == (16,)
+
+
+def save_build(folder, n, seed):
+    embeddings = np.random.default_rng(seed).normal(size=(n, 8)).astype('float32')
+    metadata = pd.DataFrame({'parent_asin': [f'{folder.name}{i}' for i in range(n)], 'price': np.arange(n, dtype=float)})
+    folder.mkdir()
+    save_faiss_index_and_metadata(str(folder / 'faiss_index.index'), str(folder / 'faiss_metadata'), embeddings, metadata)
+    return str(folder / 'faiss_index.index'), str(folder / 'faiss_metadata')
+
+
+def test_index_and_metadata_of_different_builds_are_not_paired(tmp_path):
+    index_a, metadata_a = save_build(tmp_path / 'a', 10, 0)
+    index_b, metadata_b = save_build(tmp_path / 'b', 6, 1)
+    assert read_build_id(index_a) == load_metadata(metadata_a).build_id != read_build_id(index_b)
+
+    retriever = Retriever(index_a, metadata_a, text_model=FakeEncoder(dim=8), text_model_name='fake-8',
+                          cache_db_path=None, metrics_log_path=None)
+    assert len(retriever.metadata) == 10
+    # a rebuild caught after the metadata swap and before the index swap
+    retriever.metadata_path = metadata_b
+    with pytest.raises(RuntimeError, match='different builds'):
+        retriever.load(timeout=0.2)
+    assert len(retriever.snapshot()[1]) == 10
+
+
+def test_full_vectors_are_swapped_in_with_the_index(tmp_path, monkeypatch):
+    index_path, metadata_path = str(tmp_path / 'faiss_index.index'), str(tmp_path / 'faiss_metadata')
+    old = np.random.default_rng(0).normal(size=(12, 8)).astype('float32')
+    save_faiss_index_and_metadata(index_path, metadata_path, old.copy(),
+                                  pd.DataFrame({'parent_asin': [f'A{i}' for i in range(12)]}), index_type='sq_fp16')
+    old_vectors = np.array(load_full_vectors(vectors_path(index_path), 8))
+
+    # compaction renumbers the rows, until the index is swapped in the old vectors stay
+    seen = []
+    def save_metadata(*args, **kwargs):
+        seen.append(np.array_equal(load_full_vectors(vectors_path(index_path), 8), old_vectors))
+        return metadata_store.save_metadata(*args, **kwargs)
+    monkeypatch.setattr(index, 'save_metadata', save_metadata)
+    save_faiss_index_and_metadata(index_path, metadata_path, old[::2].copy(),
+                                  pd.DataFrame({'parent_asin': [f'A{i}' for i in range(0, 12, 2)]}), index_type='sq_fp16')
+    assert seen == [True]
+    np.testing.assert_array_equal(load_full_vectors(vectors_path(index_path), 8), old_vectors[::2])
+
+    retriever = Retriever(index_path, metadata_path, text_model=FakeEncoder(dim=8), text_model_name='fake-8',
+                          cache_db_path=None, metrics_log_path=None)
+    assert len(retriever.full_vectors) == len(retriever.metadata) == 6
+
+
+def test_encode_options_are_part_of_the_cache_key():
+    class ScaledEncoder(FakeEncoder):
+        def encode(self, texts, batch_size=32, normalize_embeddings=False, **kwargs):
+            vectors = super().encode(texts, batch_size=batch_size)
+            return vectors if normalize_embeddings else 3 * vectors
+
+    encoder = CachedEncoder(ScaledEncoder(dim=8), LRUCache(), model_name='fake-8')
+    raw = encoder.encode(['red dress'])
+    normalized = encoder.encode(['red dress'], normalize_embeddings=True)
+    np.testing.assert_allclose(raw, 3 * normalized, rtol=1e-6)
+    np.testing.assert_array_equal(encoder.encode(['red dress'], show_progress_bar=False), raw)
+    np.testing.assert_array_equal(encoder.encode(['red dress'], normalize_embeddings=True), normalized)
@@ -0,0 +1,69 @@
+import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import index
+from server import RetrievalServer
+
+
+class RecordingRetriever:
+    text_model = None
+
+    def __init__(self):
+        self.calls = []
+
+    def search(self, query_text, **kwargs):
+        self.calls.append(kwargs)
+        return pd.DataFrame([{'parent_asin': 'A1', 'title': query_text}])
+
+
+def post_search(server, body):
+    server.executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        status, _, payload = asyncio.run(server.route('POST', '/search', json.dumps(body).encode('utf-8')))
+    finally:
+        server.executor.shutdown()
+    return status, json.loads(payload)
+
+
+def test_unknown_filter_is_a_bad_request():
+    retriever = RecordingRetriever()
+    server = RetrievalServer(retriever)
+    status, payload = post_search(server, {'query': 'red dress', 'filters': {'colour': ['red']}})
+    assert status == 400
+    assert 'Unknown filter: colour' in payload['error']
+    for body in ({'filters': {'price': 20}},
+                 {'filters': {'price': ['cheap', None]}},
+                 {'filters': {'store': 'Nike'}},
+                 {'filters': {'store': 5}},
+                 {'base_k': 'abc'},
+                 {'base_k': 0}):
+        status, payload = post_search(server, {'query': 'red dress', **body})
+        assert status == 400, body
+        assert payload['error']
+    assert retriever.calls == []
+
+    status, _ = post_search(server, {'query': 'red dress', 'base_k': '5',
+                                     'filters': {'store': ['Nike'], 'price': [None, 80]}})
+    assert status == 200
+    assert retriever.calls[0]['base_k'] == 5
+
+
+def test_request_cannot_choose_the_openai_key():
+    retriever = RecordingRetriever()
+    server = RetrievalServer(retriever)
+    status, payload = post_search(server, {'query': 'red dress', 'openai_api_key': 'sk-from-request',
+                                           'filters': {'price': [20, 80]}})
+    assert status == 200
+    assert payload['n_results'] == 1
+    assert 'openai_api_key' not in retriever.calls[0]
+
+
+def test_openai_clients_are_bounded():
+    for i in range(100):
+        index.get_openai_client(f'sk-{i}')
+    assert len(index._openai_clients._data) <= index._openai_clients.max_size
+    # the most recent clients are reused
+    assert index.get_openai_client('sk-99') is index.get_openai_client('sk-99')